@@ -0,0 +1,316 @@
+import re
+import time
+import xml.etree.ElementTree as ET
+import numpy as np
+import core
+
+
+# Tokens of the BIF format: quoted strings, comment starts, punctuation, and
+# words (names, values and numbers).
+TOKEN = re.compile(r'"[^"]*"|//|/\*|[{}()\[\];,|]|[^\s{}()\[\];,|"]+')
+
+
+def read(path, validate=True, timings=None):
+    """Read a Bayesian network from a BIF or XMLBIF file.
+
+    The format is chosen by the file extension: files ending in ``.xml`` or
+    ``.xmlbif`` are read with ``read_xmlbif``, all others with ``read_bif``.
+    """
+    if path.lower().endswith(('.xml', '.xmlbif')):
+        return read_xmlbif(path, validate, timings)
+    return read_bif(path, validate, timings)
+
+
+def read_bif(source, validate=True, timings=None):
+    """Read a Bayesian network from a file in the BIF format.
+
+    The file is tokenized line by line, and the probabilities of each CPT are
+    written directly into a dense array, so that no intermediate dictionary
+    of table entries is built. The network is then created with
+    ``core.BayesNet.from_spec``.
+
+    Both forms of probability blocks are supported: lists of rows of the form
+    ``(vp_1, ..., vp_k) p_1, ..., p_d;`` (optionally with a ``default`` row,
+    which applies to all rows that are not listed), and a single ``table``
+    entry, in which the values of the child vary slowest and those of the
+    last parent fastest.
+
+    Arguments
+    ---------
+    source : str or file
+        The path of the file, or an open file.
+
+    validate : bool
+        Whether to validate the network. See ``core.BayesNet.from_spec``.
+        Defaults to True.
+
+    timings : dict
+        If given, the time spent on parsing and on constructing the network
+        (in seconds) is stored under the keys 'parse' and 'build'.
+
+    Returns
+    -------
+    The network.
+    """
+    start = time.time()
+    f = open(source) if isinstance(source, str) else source
+    domains = {}
+    parents = {}
+    cpts = {}
+    try:
+        tokens = tokenize(f)
+        for tok in tokens:
+            if tok == 'network':
+                next(tokens)
+                skip_block(tokens)
+            elif tok == 'variable':
+                name = unquote(next(tokens))
+                domains[name] = parse_variable(tokens)
+            elif tok == 'probability':
+                child, ps = parse_scope(tokens)
+                for v in [child] + ps:
+                    if v not in domains:
+                        raise RuntimeError("Unknown variable '{0}'".format(v))
+                parents[child] = ps
+                cpts[child] = parse_probability(tokens, domains, child, ps)
+            else:
+                raise RuntimeError("Unexpected token '{0}'".format(tok))
+    finally:
+        if f is not source:
+            f.close()
+    return build(domains, parents, cpts, validate, timings, start)
+
+
+def read_xmlbif(source, validate=True, timings=None):
+    """Read a Bayesian network from a file in the XMLBIF format.
+
+    The file is parsed incrementally, and every ``VARIABLE`` and
+    ``DEFINITION`` (or ``PROBABILITY``) element is discarded as soon as it
+    has been processed. In a ``TABLE``, the values of the ``FOR`` variable
+    vary fastest, and those of the ``GIVEN`` variables slower, the first one
+    slowest.
+
+    Arguments
+    ---------
+    source : str or file
+        The path of the file, or an open file.
+
+    validate, timings :
+        See ``read_bif``.
+
+    Returns
+    -------
+    The network.
+    """
+    start = time.time()
+    domains = {}
+    parents = {}
+    tables = {}
+    for _, elem in ET.iterparse(source, events=('end',)):
+        tag = elem.tag.upper()
+        if tag == 'VARIABLE':
+            name = child_text(elem, 'NAME')
+            domains[name] = tuple(
+                (c.text or '').strip() for c in elem
+                if c.tag.upper() == 'OUTCOME')
+            elem.clear()
+        elif tag in ('DEFINITION', 'PROBABILITY'):
+            child = child_text(elem, 'FOR')
+            parents[child] = [(c.text or '').strip() for c in elem
+                              if c.tag.upper() == 'GIVEN']
+            tables[child] = child_text(elem, 'TABLE')
+            elem.clear()
+    cpts = {}
+    for child, text in tables.items():
+        for v in [child] + parents[child]:
+            if v not in domains:
+                raise RuntimeError("Unknown variable '{0}'".format(v))
+        shape = tuple(len(domains[v]) for v in parents[child] + [child])
+        values = np.array(text.split(), dtype=float)
+        if values.size != np.prod(shape):
+            raise RuntimeError(
+                "Invalid table size for variable '{0}'".format(child))
+        cpts[child] = values.reshape(shape)
+    return build(domains, parents, cpts, validate, timings, start)
+
+
+def build(domains, parents, cpts, validate, timings, start):
+    """Create the network of a parsed file and record the timings."""
+    parsed = time.time()
+    bn = core.BayesNet.from_spec(domains, parents, cpts, validate)
+    if timings is not None:
+        timings['parse'] = parsed - start
+        timings['build'] = time.time() - parsed
+    return bn
+
+
+def tokenize(lines):
+    """Generate the tokens of the BIF text ``lines``, skipping comments."""
+    in_comment = False
+    for line in lines:
+        pos = 0
+        while pos < len(line):
+            if in_comment:
+                end = line.find('*/', pos)
+                if end < 0:
+                    break
+                pos = end + 2
+                in_comment = False
+                continue
+            m = TOKEN.search(line, pos)
+            if m is None:
+                break
+            tok = m.group()
+            pos = m.end()
+            if tok == '//':
+                break
+            if tok == '/*':
+                in_comment = True
+                continue
+            yield tok
+
+
+def unquote(tok):
+    """Remove the quotes of a quoted string token."""
+    if len(tok) >= 2 and tok[0] == '"' and tok[-1] == '"':
+        return tok[1:-1]
+    return tok
+
+
+def expect(tokens, expected):
+    """Consume the next token and check that it is ``expected``."""
+    tok = next(tokens, None)
+    if tok != expected:
+        raise RuntimeError("Expected '{0}', found '{1}'".format(expected, tok))
+
+
+def skip_block(tokens):
+    """Skip a block in braces, including nested blocks."""
+    expect(tokens, '{')
+    depth = 1
+    for tok in tokens:
+        if tok == '{':
+            depth += 1
+        elif tok == '}':
+            depth -= 1
+            if depth == 0:
+                return
+    raise RuntimeError('Unexpected end of file')
+
+
+def skip_statement(tokens):
+    """Skip all tokens up to and including the next ';'."""
+    for tok in tokens:
+        if tok == ';':
+            return
+    raise RuntimeError('Unexpected end of file')
+
+
+def parse_variable(tokens):
+    """Parse the block of a variable declaration and return its domain."""
+    expect(tokens, '{')
+    domain = None
+    for tok in tokens:
+        if tok == '}':
+            if domain is None:
+                raise RuntimeError('Variable without a type')
+            return domain
+        if tok == 'type':
+            expect(tokens, 'discrete')
+            expect(tokens, '[')
+            size = int(next(tokens))
+            expect(tokens, ']')
+            expect(tokens, '{')
+            domain = []
+            for value in tokens:
+                if value == '}':
+                    break
+                if value != ',':
+                    domain.append(unquote(value))
+            if len(domain) != size:
+                raise RuntimeError('Invalid number of values')
+            domain = tuple(domain)
+            expect(tokens, ';')
+        else:
+            skip_statement(tokens)
+    raise RuntimeError('Unexpected end of file')
+
+
+def parse_scope(tokens):
+    """Parse ``( child | p_1, ..., p_k )`` and return the child and the list
+    of parents."""
+    expect(tokens, '(')
+    names = []
+    for tok in tokens:
+        if tok == ')':
+            break
+        if tok not in (',', '|'):
+            names.append(unquote(tok))
+    return names[0], names[1:]
+
+
+def parse_numbers(tokens):
+    """Parse a list of numbers up to the next ';'."""
+    values = []
+    for tok in tokens:
+        if tok == ';':
+            return np.array(values, dtype=float)
+        if tok != ',':
+            values.append(tok)
+    raise RuntimeError('Unexpected end of file')
+
+
+def parse_probability(tokens, domains, child, parents):
+    """Parse the block of a probability declaration into a dense CPT."""
+    shape = tuple(len(domains[v]) for v in parents + [child])
+    indices = [{d: i for i, d in enumerate(domains[v])} for v in parents]
+    cpt = np.zeros(shape)
+    assigned = np.zeros(shape[:-1], dtype=bool)
+    default = None
+    expect(tokens, '{')
+    for tok in tokens:
+        if tok == '}':
+            if default is not None:
+                cpt[~assigned] = default
+            return cpt
+        if tok == 'table':
+            values = parse_numbers(tokens)
+            if values.size != cpt.size:
+                raise RuntimeError(
+                    "Invalid table size for variable '{0}'".format(child))
+            # The child varies slowest in a table entry.
+            table = values.reshape((shape[-1],) + shape[:-1])
+            cpt = np.moveaxis(table, 0, -1).copy()
+            assigned[...] = True
+        elif tok == 'default':
+            default = parse_numbers(tokens)
+        elif tok == '(':
+            row = []
+            for value in tokens:
+                if value == ')':
+                    break
+                if value != ',':
+                    row.append(unquote(value))
+            try:
+                index = tuple(idx[d] for idx, d in zip(indices, row))
+            except KeyError as e:
+                raise RuntimeError(
+                    "Invalid value '{0}' in CPT of variable '{1}'".format(
+                        e.args[0], child))
+            if len(index) != len(parents):
+                raise RuntimeError(
+                    "Invalid row in CPT of variable '{0}'".format(child))
+            cpt[index] = parse_numbers(tokens)
+            assigned[index] = True
+        else:
+            skip_statement(tokens)
+    raise RuntimeError('Unexpected end of file')
+
+
+def child_text(elem, tag):
+    """Get the stripped text of the first child of ``elem`` with the given
+    tag."""
+    for c in elem:
+        if c.tag.upper() == tag:
+            return (c.text or '').strip()
+    raise RuntimeError("Missing element '{0}'".format(tag))
@@ -1,4 +1,5 @@
-from functools import reduce
+import heapq
+import itertools
 import math
 import networkx as nx
 import numpy as np
@@ -6,6 +7,10 @@ import matplotlib.pyplot as plt
 from conf import *
 
 
+# Value used in place of log(0) in factor tables.
+LOG_ZERO = -1e6
+
+
 class Node(object):
     def __init__(self):
         self.neighbors = []
@@ -14,12 +19,40 @@ class Node(object):
     def connect_to(self, node):
         self.neighbors.append(node)
 
-    def send(self):
+    def send(self, damping=0):
+        """Send messages to all neighbors and return the maximum change of
+        the sent messages."""
+        change = 0.0
         for fnode in self.neighbors:
-            self.send_one(fnode)
+            change = max(change, self.send_one(fnode, damping))
+        return change
+
+    def send_one(self, target, damping=0):
+        """Send a message to the target node, which should be a neighbor in
+        the factor graph."""
+        return target.receive(self, self.message(target), damping)
+
+    def receive(self, source, msg, damping=0):
+        """Store a message received from ``source``.
 
-    def receive(self, source, msg):
+        If ``damping`` is positive, the stored message is the mixture
+        (1 - damping) * msg + damping * old in the probability domain, where
+        old is the previously received message from ``source``.
+
+        Returns
+        -------
+        The maximum absolute change of the stored message in the probability
+        domain (infinite, if no message had been received before).
+        """
+        old = self.received.get(source)
+        if old is None:
+            self.received[source] = msg
+            return np.inf
+        if damping:
+            msg = np.logaddexp(np.log1p(-damping) + msg,
+                               np.log(damping) + old)
         self.received[source] = msg
+        return residual(msg, old)
 
 
 class VariableNode(Node):
@@ -41,27 +74,32 @@ class VariableNode(Node):
         self.orig_domain = domain
         self.orig2new = dict(zip(domain, self.domain))
 
-    def init_received(self):
+    def init_received(self, warm=False):
         """
-        Initially, "hallucinate" received messages of all ones (zeros in the
-        log domain) to start the message passing algorithm.
+        Initially, "hallucinate" uniform received messages to start the
+        message passing algorithm.
+
+        If ``warm`` is True, keep the already received messages and only
+        initialize the messages from factors that have not sent any yet.
         """
-        self.received = {fnode: np.zeros(len(self.domain))
+        received = self.received if warm else {}
+        self.received = {fnode: received[fnode] if fnode in received
+                         else normalize(np.zeros(len(self.domain)))
                          for fnode in self.neighbors}
 
-    def send_one(self, target):
-        """Send a message to the target factor.
+    def message(self, target):
+        """Compute the message to the target factor.
 
         Arguments
         ---------
-        target: str
+        target: FactorNode
             The target factor, which should be a neighbor in the factor graph.
         """
         msg = np.zeros(len(self.domain))
         for fnode in self.neighbors:
             if fnode != target:
                 msg += self.received[fnode]
-        target.receive(self, normalize(msg))
+        return normalize(msg)
 
     def marginal(self):
         """Compute the marginal probability distribution of this variable."""
@@ -81,50 +119,56 @@ class FactorNode(Node):
         variables : iterable
             The variables that are in this factor. The order matters.
 
-        table : map
+        table : map or array
             Maps every tuple of possible values (v_1, ..., v_n) the variables
-            in this factor can take to the value of the factor.
+            in this factor can take to the value of the factor. Can also be a
+            dense array of factor values with one axis per variable, indexed
+            by the position of each value in the variable's domain.
         """
         super(FactorNode, self).__init__()
         self.variables = variables
-        # Map table combinations to numerical values.
-        self.table = {}
-        for comb, fvalue in table.items():
-            newcomb = tuple(graph.vs[v].orig2new[orig]
-                            for v, orig in zip(variables, comb))
-            self.table[newcomb] = fvalue
         self.name = 'F_' + ''.join(variables)
-        # Just to avoid annoying numpy warnings for log(0).
-        for k, v in self.table.items():
-            if v == 0:
-                self.table[k] = -1e6
-            else:
-                self.table[k] = np.log(v)
+        # Store the factor as a dense array in the log domain with one axis per
+        # variable (in the order of ``variables``). Combinations missing from
+        # ``table`` have a factor value of zero.
+        vnodes = [graph.vs[v] for v in variables]
+        shape = tuple(len(vnode.domain) for vnode in vnodes)
+        if isinstance(table, dict):
+            values = np.zeros(shape)
+            for comb, fvalue in table.items():
+                newcomb = tuple(vnode.orig2new[orig]
+                                for vnode, orig in zip(vnodes, comb))
+                values[newcomb] = fvalue
+        else:
+            values = np.asarray(table, dtype=float)
+            if values.shape != shape:
+                raise RuntimeError(
+                    'Invalid factor table shape {0}, expected {1}'.format(
+                        values.shape, shape))
+        self.table = log(values)
 
-    def init_received(self):
-        self.received = {}
+    def init_received(self, warm=False):
+        if not warm:
+            self.received = {}
 
-    def send_one(self, target):
-        """Send a message to the target variable.
+    def message(self, target):
+        """Compute the message to the target variable.
 
         Arguments
         ---------
-        target: str
+        target: VariableNode
             The target variable, which should be a neighbor in the factor
             graph.
         """
-        # NOTE: Variable nodes in self.neighbors are in same order as in the
-        # factor table tuples.
+        # NOTE: Variable nodes in self.neighbors are in same order as the axes
+        # of the factor table.
         target_index = self.neighbors.index(target)
-        msg = -np.Inf * np.ones(len(target.domain))
-        for comb, fvalue in self.table.items():
-            s = 0
-            for i, vnode in enumerate(self.neighbors):
-                if vnode != target:
-                    s += self.received[vnode][comb[i]]
-            s += fvalue
-            msg[comb[target_index]] = np.logaddexp(msg[comb[target_index]], s)
-        target.receive(self, msg)
+        s = self.table
+        for i, vnode in enumerate(self.neighbors):
+            if vnode != target:
+                s = s + expand(self.received[vnode], i, self.table.ndim)
+        axes = tuple(i for i in range(self.table.ndim) if i != target_index)
+        return normalize(logsumexp(s, axis=axes))
 
 
 class FactorGraph:
@@ -136,6 +180,9 @@ class FactorGraph:
         self.vs = {}
         self.fs = set()
         self.vobs = {}
+        self.evidence = {}  # Evidence factors indexed by variable name.
+        # Factors added or modified since the last run.
+        self.changed = set()
         if bn is not None:
             for v in bn.vs.values():
                 self.add_variable(v.name, v.domain)
@@ -172,14 +219,15 @@ class FactorGraph:
         variables : iterable of str
             Names of variables participating in the factor.
 
-        table : dict
+        table : dict or array
             The factor table as a dictionary from tuples of variable values to
             respective factor values in the following form:
 
               { (vp_1, vp_2, ... , vp_n): fv, ...}
 
             In the above, fv is the factor value when the participating
-            variables have values vp_1, vp_2, ... , vp_n.
+            variables have values vp_1, vp_2, ... , vp_n. Alternatively, a
+            dense array of factor values with one axis per variable.
 
         Returns
         -------
@@ -191,6 +239,7 @@ class FactorGraph:
                 unknown_vars.pop()))
         fnode = FactorNode(self, variables, table)
         self.fs.add(fnode)
+        self.changed.add(fnode)
         for v in variables:
             vnode = self.vs[v]
             vnode.connect_to(fnode)
@@ -228,7 +277,42 @@ class FactorGraph:
                                          for v in self.vs.values()},
                                 font_color=LABEL_COLOR)
 
-    def run_bp(self, niter):
+    def components(self):
+        """Split the factor graph into its connected components.
+
+        Returns
+        -------
+        A tuple of (1) a list with one breadth-first ordering for each
+        tree-structured component, given as a list of ``(node, parent)``
+        pairs starting from a variable node with parent None, (2) the variable
+        nodes and (3) the factor nodes of all other components.
+        """
+        trees = []
+        loopy = set()
+        visited = set()
+        for root in list(self.vs.values()) + list(self.fs):
+            if root in visited:
+                continue
+            visited.add(root)
+            order = [(root, None)]
+            nedges = 0
+            for node, _ in order:
+                nedges += len(node.neighbors)
+                for neighbor in node.neighbors:
+                    if neighbor not in visited:
+                        visited.add(neighbor)
+                        order.append((neighbor, node))
+            # Every edge is counted once from each end point.
+            if nedges // 2 == len(order) - 1:
+                trees.append(order)
+            else:
+                loopy.update(node for node, _ in order)
+        return (trees,
+                [v for v in self.vs.values() if v in loopy],
+                [f for f in self.fs if f in loopy])
+
+    def run_bp(self, niter, tol=None, damping=0, record='full',
+               exact_trees=False, warm_start=False):
         """Run belief propagation for a number of iterations.
 
         The algorithm alternates between sending messages from each variable
@@ -236,31 +320,193 @@ class FactorGraph:
         neighboring variable nodes. One iteration is completed when every
         variable and factor node has send all its messages.
 
+        On tree-structured connected components of the factor graph a single
+        pass of messages from the leaves to a root and back to the leaves
+        gives exact marginals. If ``exact_trees`` is True, such components
+        are handled by this two-pass schedule in the first iteration and left
+        alone afterwards, so that ``damping`` and ``tol`` only apply to the
+        other components, and their messages do not contribute to the
+        residual. If the whole graph is a forest, the algorithm stops after
+        that first iteration, and only two rows of marginals are recorded
+        for ``record='full'``.
+
         Arguments
         ---------
         niter: int
-            The number of iterations.
+            The (maximum) number of iterations.
+
+        tol: float
+            If given, stop as soon as the maximum absolute change of any
+            message (in the probability domain) during an iteration is below
+            ``tol``. Defaults to None (always run ``niter`` iterations).
+
+        damping: float
+            Damping factor in [0, 1). Every message is replaced by a mixture
+            of the new message with weight ``1 - damping`` and the previous
+            one with weight ``damping``. Damping helps loopy graphs, on which
+            the messages oscillate, to converge. Defaults to 0 (no damping).
+
+        record: str or int
+            Which marginals to record. See ``MarginalHistory``. Defaults to
+            'full' (initial marginals and marginals after every iteration).
+
+        exact_trees: bool
+            Whether to use the two-pass schedule on tree-structured
+            components. Defaults to False.
+
+        warm_start: bool
+            If True, start from the messages of the previous run instead of
+            uniform messages. When the observations changed only slightly
+            since then, far fewer iterations are needed to converge (together
+            with ``tol``). Defaults to False.
+
+        Returns
+        -------
+        An ``InferenceResult`` containing (1) the marginal distribution of
+        each variable at each recorded iteration, (2) the domain of each
+        variable, and (3) the dictionary of observed variables and their
+        values. The number of iterations that were run and the maximum message
+        change in the last iteration are available as the ``niter`` and
+        ``residual`` attributes.
+        """
+        for v in self.vs.values():
+            v.init_received(warm_start)
+        for f in self.fs:
+            f.init_received(warm_start)
+        self.changed = set()
+        names = list(self.vs.keys())
+        history = MarginalHistory(
+            names, [len(self.vs[v].domain) for v in names], niter, record)
+
+        def marginals():
+            m = np.zeros(history.values.shape[1:])
+            for i, v in enumerate(names):
+                m[i, :len(self.vs[v].domain)] = self.get_marginal(v)
+            return m
+
+        history.update(0, marginals)
+        if exact_trees:
+            trees, loopy_vs, loopy_fs = self.components()
+        else:
+            trees, loopy_vs, loopy_fs = [], self.vs.values(), self.fs
+        change = np.inf
+        it = 0
+        while it < niter:
+            change = 0.0
+            if it == 0:
+                for order in trees:
+                    # Collect messages to the root, then distribute them.
+                    for node, parent in reversed(order[1:]):
+                        node.send_one(parent)
+                    for node, parent in order:
+                        for neighbor in node.neighbors:
+                            if neighbor is not parent:
+                                node.send_one(neighbor)
+            for v in loopy_vs:
+                change = max(change, v.send(damping))
+            for f in loopy_fs:
+                change = max(change, f.send(damping))
+            it += 1
+            history.update(it, marginals)
+            if (tol is not None and change < tol) or not loopy_vs:
+                break
+        marg = history.result(it, marginals)
+        domains = {v.name: v.orig_domain for v in self.vs.values()}
+        return InferenceResult(marg, domains, self.vobs,
+                               niter=it, residual=change)
+
+    def run_residual_bp(self, tol=1e-6, max_updates=None, warm_start=False):
+        """Run residual belief propagation.
+
+        Instead of sending all messages in every iteration, keep a priority
+        queue of pending factor-to-variable messages keyed by their residual,
+        i.e., by how much they would change if sent now. Always send the
+        message with the largest residual and then recompute only the messages
+        that depend on it. The algorithm stops when the largest residual drops
+        below ``tol``.
+
+        Arguments
+        ---------
+        tol: float
+            Convergence tolerance on the maximum absolute change of a message
+            (in the probability domain).
+
+        max_updates: int
+            Maximum number of factor-to-variable messages to send. Defaults to
+            None (no limit).
+
+        warm_start: bool
+            If True, start from the messages of the previous run and only
+            propagate from the factors that were added or modified since then
+            (e.g., by ``condition`` or ``retract``). A query that differs from
+            the previous one in a few observations then converges after a
+            few message updates. Defaults to False.
 
         Returns
         -------
-        A tuple containing (1) the marginal distribution of each variable at
-        each iteration, (2) the domain of each variable, and (3) the dictionary
-        of observed variables and their values.
+        An ``InferenceResult`` with the final marginal distribution of each
+        variable (as a 1 x |domain| array), the domain of each variable, and
+        the dictionary of observed variables and their values. The number of
+        sent messages and the final residual are available as the ``nupdates``
+        and ``residual`` attributes.
         """
         for v in self.vs.values():
-            v.init_received()
+            v.init_received(warm_start)
         for f in self.fs:
-            f.init_received()
-        marg = {v: self.get_marginal(v) for v in self.vs}
-        for it in range(niter):
+            f.init_received(warm_start)
+        if warm_start:
+            sources = [f for f in self.fs if f in self.changed]
+            for f in sources:
+                for v in f.neighbors:
+                    v.send_one(f)
+        else:
+            sources = self.fs
             for v in self.vs.values():
                 v.send()
-            for f in self.fs:
-                f.send()
-            for v in self.vs:
-                marg[v] = np.vstack((marg[v], self.get_marginal(v)))
+        self.changed = set()
+        # Entries of the queue are (-residual, version, factor, variable). An
+        # entry is stale if a newer version of the same message was queued.
+        queue = []
+        pending = {}
+        versions = itertools.count()
+
+        def update(fnode, exclude=None):
+            for vnode in fnode.neighbors:
+                if vnode is not exclude:
+                    msg = fnode.message(vnode)
+                    r = residual(msg, vnode.received[fnode])
+                    version = next(versions)
+                    pending[(fnode, vnode)] = (version, msg)
+                    heapq.heappush(queue, (-r, version, fnode, vnode))
+
+        for f in sources:
+            update(f)
+        nupdates = 0
+        max_residual = 0.0
+        while queue:
+            r, version, fnode, vnode = queue[0]
+            entry = pending.get((fnode, vnode))
+            if entry is None or entry[0] != version:
+                heapq.heappop(queue)
+                continue
+            max_residual = -r
+            if max_residual < tol or (max_updates is not None and
+                                      nupdates >= max_updates):
+                break
+            heapq.heappop(queue)
+            vnode.receive(fnode, entry[1])
+            del pending[(fnode, vnode)]
+            nupdates += 1
+            for f in vnode.neighbors:
+                if f is not fnode:
+                    vnode.send_one(f)
+                    update(f, exclude=vnode)
+        else:
+            max_residual = 0.0
+        marg = {v: self.get_marginal(v)[np.newaxis] for v in self.vs}
         domains = {v.name: v.orig_domain for v in self.vs.values()}
-        return (marg, domains, self.vobs)
+        return InferenceResult(marg, domains, self.vobs,
+                               nupdates=nupdates, residual=max_residual)
 
     def condition(self, observations):
         """Condition on the given observations.
@@ -268,33 +514,81 @@ class FactorGraph:
         More precisely, for every ``(variable, value)`` pair in the provided
         dictionary ``observations``, the condition that ``variable`` is equal
         to ``value`` is *added* to the existing observations in the factor
-        graph (if any).
+        graph (if any). A new observation of an already observed variable
+        replaces the old one. Observations can be removed again by
+        ``retract``.
 
         Arguments
         ---------
         observations: dict of variable -> value
             The observed values for one or more variables in the factor graph.
         """
+        self.check_observations(observations)
+        self.vobs.update(observations)
+        for name, value in observations.items():
+            # Every observed variable has its own evidence factor, which is
+            # created on the first observation and reused afterwards.
+            table = indicator(len(self.vs[name].domain),
+                              self.vs[name].orig2new[value])
+            if name in self.evidence:
+                self.evidence[name].table = table
+                self.changed.add(self.evidence[name])
+            else:
+                fnode = self.add_factor((name,), {})
+                fnode.table = table
+                self.evidence[name] = fnode
+
+    def retract(self, variables):
+        """Remove the observations of the given variables.
+
+        The evidence factors of the variables are kept in the graph, but
+        their tables are reset to all ones, so that they have no effect.
+
+        Arguments
+        ---------
+        variables: iterable of str
+            The variables whose observations are removed. Variables that are
+            not observed are ignored.
+        """
+        for name in variables:
+            if name in self.vobs:
+                del self.vobs[name]
+                self.evidence[name].table = np.zeros(
+                    len(self.vs[name].domain))
+                self.changed.add(self.evidence[name])
+
+    def check_observations(self, observations):
+        """Raise an error if ``observations`` contains unknown variables or
+        values."""
         unknown_vars = set(observations.keys()) - set(self.vs.keys())
         if unknown_vars != set():
             raise RuntimeError("Unknown variable '{0}'".format(
                 unknown_vars.pop()))
-        self.vobs.update(observations)
         for name, value in observations.items():
-            table = {(d,): 0 for d in self.vs[name].orig_domain}
-            table[(value,)] = 1
-            # Check if there is an existing factor that is only connected
-            # to the observed variable. If that is the case, replace its
-            # table by a new table corresponding to the observed value,
-            # otherwise create a new factor with that table.
-            found = False
-            for fnode in self.fs:
-                if len(fnode.variables) == 1 and fnode.variables[0] == name:
-                    fnew = FactorNode(self, (name,), table)
-                    fnode.table = fnew.table
-                    found = True
-            if not found:
-                fnode = self.add_factor((name,), table)
+            if value not in self.vs[name].orig2new:
+                raise RuntimeError(
+                    "Invalid value '{0}' for variable '{1}'".format(
+                        value, name))
+
+    def compile(self):
+        """Compile the factor graph into flat arrays for fast inference.
+
+        The compiled graph is a snapshot of the current factors and
+        observations; later changes to this graph do not affect it.
+
+        Returns
+        -------
+        A ``CompiledFactorGraph``.
+        """
+        return CompiledFactorGraph(self)
+
+    def run_bp_batch(self, observations, niter, tol=None, damping=0):
+        """Run belief propagation for a batch of observation sets at once.
+
+        Convenience method. Compiles the graph and calls
+        ``CompiledFactorGraph.run_bp_batch``.
+        """
+        return self.compile().run_bp_batch(observations, niter, tol, damping)
 
     def get_marginal(self, var):
         """Get the marginal probability distribution of variable ``var``.
@@ -311,6 +605,446 @@ class FactorGraph:
         return self.vs[var].marginal()
 
 
+class InferenceResult(tuple):
+    """The ``(marginals, domains, observations)`` triple returned by inference
+    methods.
+
+    It behaves exactly like a plain tuple, but additional information about
+    the run (e.g., number of iterations) is available as attributes.
+    """
+
+    def __new__(cls, marginals, domains, observations, **info):
+        result = super(InferenceResult, cls).__new__(
+            cls, (marginals, domains, observations))
+        result.__dict__.update(info)
+        return result
+
+    def __getnewargs__(self):
+        return tuple(self)
+
+
+class MarginalHistory(object):
+    """Preallocated storage for the marginals recorded during a BP run.
+
+    The marginals of all variables at one iteration are stored as a row of a
+    single ``nrows x n x D`` array, where ``n`` is the number of variables and
+    ``D`` the largest domain size. The number of rows is fixed in advance by
+    the recording mode ``record``, which can be one of
+
+        * 'none': record nothing,
+        * 'final': record only the final marginals,
+        * 'full': record the initial marginals and the marginals after every
+          iteration,
+        * an int k: record the marginals at iterations 0, k, 2k, ...
+
+    For all modes but 'none', the final marginals are always recorded as the
+    last row, even if the run stops early.
+    """
+
+    def __init__(self, names, sizes, niter, record='full'):
+        """
+        Arguments
+        ---------
+        names: list of str
+            The variable names.
+
+        sizes: list of int
+            The domain size of each variable.
+
+        niter: int
+            The maximum number of iterations of the run.
+
+        record: str or int
+            The recording mode.
+        """
+        self.names = names
+        self.sizes = sizes
+        if record == 'none':
+            self.step, nrows = None, 0
+        elif record == 'final':
+            self.step, nrows = None, 1
+        elif record == 'full':
+            self.step, nrows = 1, niter + 1
+        elif isinstance(record, int) and record > 0:
+            self.step, nrows = record, niter // record + 2
+        else:
+            raise RuntimeError("Invalid recording mode '{0}'".format(record))
+        dmax = max(sizes) if len(sizes) else 0
+        self.values = np.empty((nrows, len(names), dmax))
+        self.count = 0
+        self.last = None
+
+    def update(self, it, marginals):
+        """Record the marginals at iteration ``it``, if required.
+
+        Arguments
+        ---------
+        it: int
+            The current iteration.
+
+        marginals: callable
+            Returns the current marginals as an n x D array. It is only
+            called if the marginals need to be recorded.
+        """
+        if self.step is not None and it % self.step == 0:
+            self.values[self.count] = marginals()
+            self.count += 1
+            self.last = it
+
+    def result(self, it, marginals):
+        """Finish recording after the final iteration ``it``.
+
+        Returns
+        -------
+        A dictionary that maps each variable to a k x |domain| array of its
+        recorded marginals.
+        """
+        if self.values.shape[0] > 0 and self.last != it:
+            self.values[self.count] = marginals()
+            self.count += 1
+            self.last = it
+        values = self.values[:self.count]
+        return {name: values[:, i, :self.sizes[i]]
+                for i, name in enumerate(self.names)}
+
+
+class CompiledFactorGraph(object):
+    """A factor graph laid out in flat arrays for fast belief propagation.
+
+    Variables are mapped to integers ``0, ..., n - 1`` and every edge of the
+    factor graph to an integer ``0, ..., E - 1``, with the edges of each
+    variable being contiguous. Messages in both directions are stored in
+    ``E x D`` arrays, where ``D`` is the largest domain size (shorter domains
+    are padded). Factors with the same table shape are stacked together, so
+    that a whole BP iteration amounts to a few batched array operations per
+    group of factors. All factor tables live in the single flat buffer
+    ``tables``.
+
+    The evidence factors of the factor graph (see ``FactorGraph.condition``)
+    are not laid out with the other factors, but become rows of the unary
+    log-potentials ``evidence``, so that new observations replace them.
+
+    Objects of this class should be created via ``FactorGraph.compile``.
+    """
+
+    def __init__(self, fgraph):
+        vnodes = list(fgraph.vs.values())
+        names = [vnode.name for vnode in vnodes]
+        index = {name: i for i, name in enumerate(names)}
+        # Group factors by the domain sizes of their variables. Evidence
+        # factors are handled separately, see below.
+        evidence = set(fgraph.evidence.values())
+        fnodes = [fnode for fnode in fgraph.fs if fnode not in evidence]
+        groups = {}
+        for fnode in fnodes:
+            groups.setdefault(fnode.table.shape, []).append(fnode)
+        # Number edges so that the edges of each variable are contiguous.
+        edges = [(index[vnode.name], j, a)
+                 for j, fnode in enumerate(fnodes)
+                 for a, vnode in enumerate(fnode.neighbors)]
+        edges.sort()
+        edge_id = {(j, a): e for e, (_, j, a) in enumerate(edges)}
+        fid = {fnode: j for j, fnode in enumerate(fnodes)}
+        self.setup(names, [vnode.orig_domain for vnode in vnodes],
+                   fgraph.vobs, np.array([i for i, _, _ in edges], dtype=int))
+        # Lay out factor tables group by group in one contiguous buffer.
+        self.tables = np.concatenate(
+            [fnode.table.ravel() for shape in sorted(groups)
+             for fnode in groups[shape]] or [np.zeros(0)])
+        self.groups = []
+        offset = 0
+        for shape in sorted(groups):
+            gfnodes = groups[shape]
+            size = len(gfnodes) * int(np.prod(shape))
+            table = self.tables[offset:offset + size].reshape(
+                (len(gfnodes),) + shape)
+            gedges = np.array([[edge_id[(fid[fnode], a)]
+                                for a in range(len(shape))]
+                               for fnode in gfnodes], dtype=int)
+            self.groups.append((table, gedges))
+            offset += size
+        # Unary log-potentials of observed variables.
+        self.evidence = np.zeros((len(self.names), self.dmax))
+        for name, fnode in fgraph.evidence.items():
+            i = self.index[name]
+            self.evidence[i, :self.dsize[i]] = fnode.table
+
+    def setup(self, names, domains, vobs, edge_var):
+        """Set the variables, the observations and the edges of the graph,
+        together with all state that is derived from them.
+
+        The factor tables ``tables`` and ``groups`` and the unary
+        log-potentials ``evidence`` are not touched.
+
+        Arguments
+        ---------
+        names : list of str
+            The variable names, in the order of their integer ids.
+
+        domains : list
+            The domain of each variable.
+
+        vobs : dict
+            The observed values of the observed variables.
+
+        edge_var : array of int
+            The variable of every edge.
+        """
+        self.names = list(names)
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.domains = dict(zip(self.names, domains))
+        self.orig2new = [{d: i for i, d in enumerate(domain)}
+                         for domain in domains]
+        self.dsize = np.array([len(domain) for domain in domains], dtype=int)
+        self.dmax = max(self.dsize) if len(self.dsize) else 0
+        self.valid = np.arange(self.dmax) < self.dsize[:, None]
+        self.vobs = dict(vobs)
+        self.edge_var = edge_var
+        degree = np.bincount(self.edge_var, minlength=len(self.names))
+        self.var_start = np.cumsum(degree) - degree
+        self.has_edges = degree > 0
+
+    def condition(self, observations):
+        """Condition on the given observations.
+
+        Same as ``FactorGraph.condition``, but only affects this compiled
+        graph. Observations are stored as unary log-potentials, so switching
+        between queries does not require recompiling.
+
+        Arguments
+        ---------
+        observations: dict of variable -> value
+            The observed values for one or more variables in the graph.
+        """
+        self.check_observations(observations)
+        self.vobs.update(observations)
+        for name, value in observations.items():
+            i = self.index[name]
+            self.evidence[i] = LOG_ZERO
+            self.evidence[i, self.orig2new[i][value]] = 0
+
+    def retract(self, variables):
+        """Remove the observations of the given variables (if any)."""
+        for name in variables:
+            if name in self.vobs:
+                del self.vobs[name]
+                self.evidence[self.index[name]] = 0
+
+    def check_observations(self, observations):
+        """Raise an error if ``observations`` contains unknown variables or
+        values."""
+        for name, value in observations.items():
+            if name not in self.index:
+                raise RuntimeError("Unknown variable '{0}'".format(name))
+            if value not in self.orig2new[self.index[name]]:
+                raise RuntimeError(
+                    "Invalid value '{0}' for variable '{1}'".format(
+                        value, name))
+
+    def evidence_batch(self, observations):
+        """Stack the unary log-potentials of a batch of observation sets on
+        top of the observations of this graph.
+
+        Arguments
+        ---------
+        observations: list of dict of variable -> value
+            One set of observations per batch element.
+
+        Returns
+        -------
+        A B x n x D array of unary log-potentials.
+        """
+        evidence = np.repeat(self.evidence[np.newaxis], len(observations),
+                             axis=0)
+        for b, obs in enumerate(observations):
+            self.check_observations(obs)
+            for name, value in obs.items():
+                i = self.index[name]
+                evidence[b, i] = LOG_ZERO
+                evidence[b, i, self.orig2new[i][value]] = 0
+        return evidence
+
+    def beliefs(self, f2v, evidence):
+        """Compute the normalized log-beliefs of all variables given the
+        factor-to-variable messages ``f2v`` and the unary log-potentials
+        ``evidence``."""
+        belief = evidence.copy()
+        belief[:, self.has_edges] += np.add.reduceat(
+            f2v, self.var_start[self.has_edges], axis=1)
+        return self.normalize(belief, self.valid)
+
+    def variable_step(self, f2v, evidence, v2f=None, damping=0):
+        """Compute all variable-to-factor messages.
+
+        If the previous messages ``v2f`` are given, they are used for damping.
+
+        Returns
+        -------
+        The new messages and their maximum absolute change.
+        """
+        belief = evidence.copy()
+        belief[:, self.has_edges] += np.add.reduceat(
+            f2v, self.var_start[self.has_edges], axis=1)
+        new = self.normalize(belief[:, self.edge_var] - f2v,
+                             self.valid[self.edge_var])
+        if v2f is None:
+            return new, np.inf
+        if damping:
+            new = np.logaddexp(np.log1p(-damping) + new,
+                               np.log(damping) + v2f)
+        return new, residual(new, v2f)
+
+    def factor_step(self, v2f, f2v, damping=0):
+        """Compute all factor-to-variable messages and store them in
+        ``f2v``.
+
+        Returns
+        -------
+        The maximum absolute change of the messages.
+        """
+        change = 0.0
+        for table, gedges in self.groups:
+            ndim = table.ndim - 1
+            msgs = [expand_batch(v2f[:, gedges[:, a], :table.shape[a + 1]],
+                                 a, ndim)
+                    for a in range(ndim)]
+            for target in range(ndim):
+                s = table
+                for a in range(ndim):
+                    if a != target:
+                        s = s + msgs[a]
+                axes = tuple(a + 2 for a in range(ndim) if a != target)
+                new = logsumexp(s, axis=axes)
+                new -= logsumexp(new, axis=-1)[..., None]
+                index = (slice(None), gedges[:, target],
+                         slice(table.shape[target + 1]))
+                if damping:
+                    new = np.logaddexp(np.log1p(-damping) + new,
+                                       np.log(damping) + f2v[index])
+                change = max(change, residual(new, f2v[index]))
+                f2v[index] = new
+        return change
+
+    def normalize(self, logdist, valid):
+        """Normalize the rows of ``logdist``, ignoring padded entries."""
+        logdist = np.where(valid, logdist, -np.inf)
+        return logdist - logsumexp(logdist, axis=-1)[..., None]
+
+    def propagate(self, evidence, niter, tol=None, damping=0, history=None):
+        """Run flooding belief propagation for a batch of evidence.
+
+        Arguments
+        ---------
+        evidence: numpy array
+            A B x n x D array of unary log-potentials.
+
+        niter, tol, damping:
+            See ``FactorGraph.run_bp``.
+
+        history: MarginalHistory
+            If given, the marginals of the first batch element are recorded
+            in it.
+
+        Returns
+        -------
+        A tuple of the final factor-to-variable messages, the number of
+        iterations that were run, and the final maximum message change.
+        """
+        # Start from uniform factor-to-variable messages.
+        f2v = np.where(self.valid[self.edge_var],
+                       -np.log(self.dsize[self.edge_var])[:, None], 0)
+        f2v = np.repeat(f2v[np.newaxis], len(evidence), axis=0)
+        v2f = None
+
+        def marginals():
+            return np.exp(self.beliefs(f2v, evidence)[0])
+
+        if history is not None:
+            history.update(0, marginals)
+        change = np.inf
+        it = 0
+        while it < niter:
+            v2f, vchange = self.variable_step(f2v, evidence, v2f, damping)
+            change = max(vchange, self.factor_step(v2f, f2v, damping))
+            it += 1
+            if history is not None:
+                history.update(it, marginals)
+            if tol is not None and change < tol:
+                break
+        return f2v, it, change
+
+    def run_bp(self, niter, tol=None, damping=0, record='full'):
+        """Run belief propagation for a number of iterations.
+
+        Uses the same flooding schedule as ``FactorGraph.run_bp``, but each
+        half-iteration is computed by batched array operations.
+
+        Arguments
+        ---------
+        niter: int
+            The (maximum) number of iterations.
+
+        tol: float
+            Convergence tolerance. See ``FactorGraph.run_bp``.
+
+        damping: float
+            Damping factor. See ``FactorGraph.run_bp``.
+
+        record: str or int
+            Which marginals to record. See ``MarginalHistory``.
+
+        Returns
+        -------
+        Same as ``FactorGraph.run_bp``.
+        """
+        history = MarginalHistory(self.names, self.dsize, niter, record)
+        evidence = self.evidence[np.newaxis]
+        f2v, it, change = self.propagate(evidence, niter, tol, damping,
+                                         history)
+        marg = history.result(
+            it, lambda: np.exp(self.beliefs(f2v, evidence)[0]))
+        return InferenceResult(marg, self.domains, self.vobs,
+                               niter=it, residual=change)
+
+    def run_bp_batch(self, observations, niter, tol=None, damping=0):
+        """Run belief propagation for a batch of observation sets at once.
+
+        All messages carry a leading batch dimension, so that every step of
+        the algorithm processes the whole batch with the same array
+        operations. The observations of each batch element are added to the
+        observations of this graph. Iterations continue until all batch
+        elements have converged (or ``niter`` is reached).
+
+        Arguments
+        ---------
+        observations: list of dict of variable -> value
+            One set of observations per batch element.
+
+        niter, tol, damping:
+            See ``FactorGraph.run_bp``.
+
+        Returns
+        -------
+        An ``InferenceResult`` containing (1) a dictionary that maps each
+        variable v to a B x |domain(v)| array with the final marginals of each
+        batch element, (2) the domain of each variable, and (3) the list of
+        observations of each batch element (including the observations of
+        this graph). The number of iterations and the final maximum message
+        change are available as the ``niter`` and ``residual`` attributes.
+        """
+        evidence = self.evidence_batch(observations)
+        f2v, it, change = self.propagate(evidence, niter, tol, damping)
+        beliefs = np.exp(self.beliefs(f2v, evidence))
+        marg = {name: beliefs[:, i, :self.dsize[i]]
+                for i, name in enumerate(self.names)}
+        vobs = []
+        for obs in observations:
+            vobs.append(dict(self.vobs))
+            vobs[-1].update(obs)
+        return InferenceResult(marg, self.domains, vobs,
+                               niter=it, residual=change)
+
+
 def normalize(logdist):
     """Compute the following in a numerically stable way:
 
@@ -325,8 +1059,77 @@ def normalize(logdist):
     -------
     The normalized version of logdist again in the logarithmic domain.
     """
-    Z = reduce(np.logaddexp, logdist, -np.Inf)
-    return logdist - Z
+    return logdist - logsumexp(logdist)
+
+
+def residual(msg, old):
+    """Compute the maximum absolute difference between two normalized
+    messages in the logarithmic domain, measured in the probability domain."""
+    return np.max(np.abs(np.exp(msg) - np.exp(old)))
+
+
+def logsumexp(a, axis=None):
+    """Compute log\sum\exp(a) along ``axis`` in a numerically stable way.
+
+    Arguments
+    ---------
+    a: numpy array
+        Values in the logarithmic domain.
+
+    axis: int or tuple of int
+        The axes to sum over. Defaults to None (sum over all axes).
+
+    Returns
+    -------
+    An array with the summed axes removed (or a scalar if ``axis`` is None).
+    """
+    a = np.asarray(a, dtype=float)
+    if a.size == 0:
+        return np.log(np.sum(np.exp(a), axis=axis))
+    amax = np.max(a, axis=axis, keepdims=True)
+    amax[~np.isfinite(amax)] = 0
+    s = np.sum(np.exp(a - amax), axis=axis, keepdims=True)
+    out = np.log(s) + amax
+    if axis is None:
+        return out.item()
+    return np.squeeze(out, axis=axis)
+
+
+def log(values):
+    """Compute the elementwise logarithm of nonnegative ``values``.
+
+    Zero values are mapped to a large negative number instead of -inf, just to
+    avoid annoying numpy warnings and infinite arithmetic.
+    """
+    values = np.asarray(values, dtype=float)
+    logvalues = np.full(values.shape, LOG_ZERO)
+    np.log(values, out=logvalues, where=values > 0)
+    return logvalues
+
+
+def indicator(size, index):
+    """Get the log-domain table of a unary factor that is one at ``index``
+    and zero everywhere else."""
+    table = np.full(size, LOG_ZERO)
+    table[index] = 0
+    return table
+
+
+def expand(msg, axis, ndim):
+    """Reshape a 1D message so that it broadcasts along ``axis`` of an
+    ``ndim``-dimensional factor table."""
+    shape = [1] * ndim
+    shape[axis] = len(msg)
+    return np.reshape(msg, shape)
+
+
+def expand_batch(msgs, axis, ndim):
+    """Reshape a B x k x d array of messages (one per batch element and
+    factor) so that they broadcast along ``axis`` of a stack of k
+    ``ndim``-dimensional factor tables."""
+    shape = list(msgs.shape[:2]) + [1] * ndim
+    shape[axis + 2] = msgs.shape[2]
+    return np.reshape(msgs, shape)
 
 
 def draw_marginals(marg, markers=True):
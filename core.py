@@ -1,17 +1,32 @@
 from collections import defaultdict
 import networkx as nx
+import numpy as np
 from conf import *
 
 
 EPS = 1e-10
 
+# Number of pending edges of a BayesNet above which they are merged into its
+# sparse arrays as soon as they are as many as the merged edges.
+MERGE_SIZE = 1024
+
 
 def is_valid_cpt(table):
     """Check that ``table`` contains valid conditional prob. distributions.
 
     Note that the conditional distributions are defined over the last variable
     in the tuples, while all other variables are conditioned on.
+
+    ``table`` can also be a dense array with one axis per variable, in which
+    case the conditional distributions are over its last axis.
     """
+    if not isinstance(table, dict):
+        table = np.asarray(table, dtype=float)
+        if table.ndim == 0:
+            return False
+        if np.any(table < 0) or np.any(table > 1):
+            return False
+        return bool(np.all(np.abs(table.sum(axis=-1) - 1) <= EPS))
     probabilities = defaultdict(float)
     for combination, value in table.items():
         if value < 0 or value > 1:
@@ -21,7 +36,14 @@ def is_valid_cpt(table):
 
 
 class Variable:
-    """A Bayesian network variable."""
+    """A Bayesian network variable.
+
+    The CPT of a variable is a dense array with one axis per parent (in the
+    order of ``parents``) and a last axis for the variable itself. Each axis
+    is indexed by the position of a value in the domain of its variable.
+    """
+    __slots__ = ('name', 'domain', 'parents', 'cpt')
+
     def __init__(self, name, domain, parents=None, cpt=None):
         self.name = name
         self.domain = domain
@@ -29,12 +51,278 @@ class Variable:
         self.cpt = cpt
 
 
-class BayesNet(nx.DiGraph):
-    """A Bayesian network as a directed graph."""
+class BayesNet(object):
+    """A Bayesian network as a directed graph.
+
+    Nodes are stored with integer ids ``0, ..., n - 1`` (``self.ids`` maps
+    node names to ids, and ``self.names`` ids to names), and edges as two
+    arrays of source and target ids, in the order in which they were added.
+    For structural queries, the edges are laid out in compressed sparse row
+    form: the parents of node i are
+    ``parent_idx[parent_ptr[i]:parent_ptr[i + 1]]``, and its children
+    ``child_idx[child_ptr[i]:child_ptr[i + 1]]``.
+
+    New edges are first appended to a pending list, and indexed by their
+    end points, so that the parents and children of a node can be looked
+    up without touching the sparse arrays. The pending edges are merged
+    into the sparse arrays by ``build``, which algorithms over the whole
+    graph call before they run, or once the pending list is as long as
+    the merged one. Interleaving edge insertions and local queries thus
+    takes amortized constant time per edge.
+
+    Graph nodes do not need to be variables. A networkx view of the graph
+    is only created for drawing, see ``to_networkx``.
+    """
 
     def __init__(self):
-        super(BayesNet, self).__init__()
         self.vs = {}  # Variables of the network indexed by name.
+        self.ids = {}
+        self.names = []
+        self.src = np.zeros(0, dtype=np.int64)
+        self.dst = np.zeros(0, dtype=np.int64)
+        # Edges added since the last rebuild of the sparse arrays, and their
+        # ids by target and by source.
+        self.pending = []
+        self.pending_parents = {}
+        self.pending_children = {}
+        self.parent_ptr = np.zeros(1, dtype=np.int64)
+        self.parent_idx = np.zeros(0, dtype=np.int64)
+        self.child_ptr = np.zeros(1, dtype=np.int64)
+        self.child_idx = np.zeros(0, dtype=np.int64)
+        self.dirty = False
+
+    def add_node(self, name):
+        """Add a node with the given name, if it does not exist yet, and
+        return its id."""
+        i = self.ids.get(name)
+        if i is None:
+            i = self.ids[name] = len(self.names)
+            self.names.append(name)
+            self.dirty = True
+        return i
+
+    def add_nodes_from(self, names):
+        """Add the nodes with the given names."""
+        for name in names:
+            self.add_node(name)
+
+    def add_edge(self, u, v):
+        """Add an edge from node ``u`` to node ``v``, adding the nodes if
+        necessary. Duplicate edges are ignored."""
+        i = self.add_node(u)
+        j = self.add_node(v)
+        if i in self.parent_ids(j):
+            return
+        self.pending.append((i, j))
+        self.pending_parents.setdefault(j, []).append(i)
+        self.pending_children.setdefault(i, []).append(j)
+        self.dirty = True
+        if len(self.pending) >= max(len(self.src), MERGE_SIZE):
+            self.build()
+
+    def add_edges_from(self, edges):
+        """Add all given ``(u, v)`` edges."""
+        for u, v in edges:
+            self.add_edge(u, v)
+
+    def has_node(self, name):
+        """Check whether the graph contains node ``name``."""
+        return name in self.ids
+
+    def __contains__(self, name):
+        return name in self.ids
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def nodes(self):
+        """Get a list of the names of all nodes."""
+        return list(self.names)
+
+    def edges(self):
+        """Get a list of all edges as ``(u, v)`` pairs of node names, in the
+        order in which they were added."""
+        self.build()
+        return [(self.names[u], self.names[v])
+                for u, v in zip(self.src, self.dst)]
+
+    def has_edge(self, u, v):
+        """Check whether the graph contains an edge from ``u`` to ``v``."""
+        if u not in self.ids or v not in self.ids:
+            return False
+        return self.ids[u] in self.parent_ids(self.ids[v])
+
+    def predecessors(self, name):
+        """Get a list of the parents of node ``name``."""
+        return [self.names[i] for i in self.parent_ids(self.node_id(name))]
+
+    def successors(self, name):
+        """Get a list of the children of node ``name``."""
+        return [self.names[i] for i in self.child_ids(self.node_id(name))]
+
+    def node_id(self, name):
+        """Get the id of node ``name``."""
+        try:
+            return self.ids[name]
+        except KeyError:
+            raise RuntimeError("Unknown node '{0}'".format(name))
+
+    def parent_ids(self, i):
+        """Get the ids of the parents of the node with id ``i``, in the
+        order in which the edges were added."""
+        return self.neighbor_ids(i, self.parent_ptr, self.parent_idx,
+                                 self.pending_parents)
+
+    def child_ids(self, i):
+        """Get the ids of the children of the node with id ``i``, in the
+        order in which the edges were added."""
+        return self.neighbor_ids(i, self.child_ptr, self.child_idx,
+                                 self.pending_children)
+
+    def neighbor_ids(self, i, ptr, idx, pending):
+        """Get row ``i`` of the sparse arrays ``ptr`` and ``idx``, followed
+        by the pending entries of node ``i``."""
+        if i + 1 < len(ptr):
+            ids = idx[ptr[i]:ptr[i + 1]]
+        else:
+            # The node was added after the last rebuild.
+            ids = idx[:0]
+        if i in pending:
+            ids = np.concatenate((ids, pending[i]))
+        return ids
+
+    def build(self):
+        """Merge new edges and rebuild the sparse parent and child arrays,
+        if the graph has been modified."""
+        if not self.dirty:
+            return
+        n = len(self.names)
+        if self.pending:
+            new = np.array(self.pending, dtype=np.int64).reshape((-1, 2))
+            self.src = np.concatenate((self.src, new[:, 0]))
+            self.dst = np.concatenate((self.dst, new[:, 1]))
+            self.pending = []
+            self.pending_parents = {}
+            self.pending_children = {}
+        self.parent_ptr, self.parent_idx = csr(self.dst, self.src, n)
+        self.child_ptr, self.child_idx = csr(self.src, self.dst, n)
+        self.dirty = False
+
+    def topological_order(self):
+        """Get the names of all nodes in topological order.
+
+        Raises a ``RuntimeError``, if the graph contains a cycle.
+        """
+        self.build()
+        indegree = np.diff(self.parent_ptr)
+        order = list(np.flatnonzero(indegree == 0))
+        k = 0
+        while k < len(order):
+            children = self.child_ids(order[k])
+            indegree[children] -= 1
+            order.extend(children[indegree[children] == 0])
+            k += 1
+        if len(order) < len(self.names):
+            raise RuntimeError('Network contains a cycle')
+        return [self.names[i] for i in order]
+
+    def to_networkx(self):
+        """Convert the network structure to a networkx directed graph."""
+        g = nx.DiGraph()
+        g.add_nodes_from(self.names)
+        g.add_edges_from(self.edges())
+        return g
+
+    @classmethod
+    def from_spec(cls, domains, parents, cpts, validate=True):
+        """Build a network with all variables and CPTs at once.
+
+        Unlike calling ``add_variable`` and ``add_cpt`` for each variable,
+        all edges are inserted in a single batch, and the structure and the
+        CPTs are checked in one pass at the end.
+
+        Arguments
+        ---------
+        domains : dict
+            Maps each variable name to its domain.
+
+        parents : dict
+            Maps variable names to iterables of their parents. Variables
+            that are missing have no parents. Only variables with a CPT can
+            have parents.
+
+        cpts : dict
+            Maps variable names to their CPTs, given as in ``add_cpt``.
+            Variables that are missing have no CPT.
+
+        validate : bool
+            Whether to check that the network is acyclic and that all CPTs
+            have the right shape and are valid. Defaults to True.
+
+        Returns
+        -------
+        The new network.
+        """
+        bn = cls()
+        for name, domain in domains.items():
+            bn.vs[str(name)] = Variable(str(name), domain, None, None)
+        cpts = {str(name): table for name, table in cpts.items()}
+        normalized = {}
+        for name, ps in parents.items():
+            ps = (ps,) if isinstance(ps, str) else tuple(ps)
+            name = str(name)
+            if ps and name not in cpts:
+                raise RuntimeError(
+                    "Variable '{0}' has parents but no CPT".format(name))
+            normalized[name] = tuple(str(p) for p in ps)
+        for name, table in cpts.items():
+            ps = normalized.get(name, ())
+            for v in ps + (name,):
+                if v not in bn.vs:
+                    raise RuntimeError("Unknown variable '{0}'".format(v))
+            if isinstance(table, dict):
+                table = bn.dict_to_array(ps, name, table)
+            bn.vs[name].parents = ps
+            bn.vs[name].cpt = np.asarray(table, dtype=float)
+        bn.add_nodes_from(bn.vs)
+        bn.add_edges_from((p, v.name) for v in bn.vs.values()
+                          for p in (v.parents or ()))
+        if validate:
+            bn.validate()
+        return bn
+
+    def validate(self):
+        """Check that the network is acyclic and that all CPTs are valid.
+
+        The CPTs are checked in a single vectorized pass over all their rows.
+        """
+        self.topological_order()
+        variables = [v for v in self.vs.values() if v.cpt is not None]
+        for v in variables:
+            shape = tuple(len(self.vs[u].domain)
+                          for u in v.parents + (v.name,))
+            if v.cpt.shape != shape:
+                raise RuntimeError(
+                    "Invalid CPT shape {0} for variable '{1}', expected "
+                    "{2}".format(v.cpt.shape, v.name, shape))
+        if not variables:
+            return
+        values = np.concatenate([v.cpt.ravel() for v in variables])
+        sizes = np.array([v.cpt.shape[-1] for v in variables])
+        nrows = np.array([v.cpt.size // v.cpt.shape[-1] for v in variables])
+        # Every CPT row is a conditional distribution. Sum all rows at once.
+        starts = np.concatenate(([0], np.cumsum(np.repeat(sizes, nrows))))
+        totals = np.add.reduceat(values, starts[:-1])
+        bad_rows = (np.abs(totals - 1) > EPS) | (
+            np.minimum.reduceat(values, starts[:-1]) < 0) | (
+            np.maximum.reduceat(values, starts[:-1]) > 1)
+        if np.any(bad_rows):
+            row = np.argmax(bad_rows)
+            v = variables[np.searchsorted(np.cumsum(nrows), row, 'right')]
+            raise RuntimeError("Invalid CPT for variable '{0}'".format(v.name))
 
     def add_variable(self, name, domain):
         """Add a variable node with the given name to the network.
@@ -52,6 +340,7 @@ class BayesNet(nx.DiGraph):
             raise RuntimeError("Variable '{0}' already defined".format(name))
         v = Variable(name, domain, None, None)
         self.vs[name] = v
+        self.add_node(name)
 
     def add_cpt(self, parents, variable, table):
         """Add a conditional probability table (CPT) to the network.
@@ -64,14 +353,22 @@ class BayesNet(nx.DiGraph):
         variable : str
             Variable for which the CPT is given.
 
-        table : dict
-            The CPT as a dictionary from tuples of variable values to
-            conditional probabilities in the following form:
+        table : array or dict
+            The CPT as a dense array of conditional probabilities with one
+            axis per parent and a last axis for ``variable`` (see
+            ``Variable``).
+
+            For convenience, the CPT can also be given as a dictionary from
+            tuples of variable values to conditional probabilities in the
+            following form:
 
               { (vp_1, vp_2, ... , v_v): p, ...}
 
             In the above, p is the conditional probability of v having value
-            v_v, given that its parents have values vp_1, vp_2, etc.
+            v_v, given that its parents have values vp_1, vp_2, etc. It is
+            converted to an array, where missing combinations have a
+            probability of zero. Parent configurations without any entry
+            get a uniform distribution.
         """
         if parents is None:
             parents = ()
@@ -82,22 +379,50 @@ class BayesNet(nx.DiGraph):
         for v in list(parents) + [variable]:
             if v not in self.vs:
                 raise RuntimeError("Unknown variable '{0}'".format(v))
-        # For CPTs with no parents, accept non-iterables as table keys for user
-        # convenience, but convert them to single-element tuples here.
-        newtable = {}
-        for c, v in table.items():
-            try:
-                newtable[tuple(c)] = v
-            except TypeError:
-                newtable[(c,)] = v
-        table = defaultdict(lambda: 0.5, newtable)
+        shape = tuple(len(self.vs[v].domain) for v in parents + (variable,))
+        if isinstance(table, dict):
+            table = self.dict_to_array(parents, variable, table)
+        else:
+            table = np.asarray(table, dtype=float)
+            if table.shape != shape:
+                raise RuntimeError(
+                    'Invalid CPT shape {0}, expected {1}'.format(table.shape,
+                                                                  shape))
         if not is_valid_cpt(table):
             raise RuntimeError('Invalid CPT')
         self.vs[variable].parents = parents
         self.vs[variable].cpt = table
-        for parent in parents:
-            if not self.has_edge(parent, variable):
-                self.add_edge(parent, variable)
+        # Duplicate edges are dropped when the graph is rebuilt.
+        self.add_edges_from((parent, variable) for parent in parents)
+
+    def dict_to_array(self, parents, variable, table):
+        """Convert a CPT given as a dictionary to a dense array.
+
+        See ``add_cpt`` for the arguments.
+        """
+        variables = parents + (variable,)
+        indices = [{d: i for i, d in enumerate(self.vs[v].domain)}
+                   for v in variables]
+        array = np.zeros(tuple(len(index) for index in indices))
+        given = np.zeros(array.shape[:-1], dtype=bool)
+        for c, p in table.items():
+            # For CPTs with no parents, accept non-iterables as table keys for
+            # user convenience.
+            try:
+                c = tuple(c)
+            except TypeError:
+                c = (c,)
+            if len(c) != len(variables):
+                raise RuntimeError('Invalid CPT entry {0}'.format(c))
+            for v, index, d in zip(variables, indices, c):
+                if d not in index:
+                    raise RuntimeError(
+                        "Invalid value '{0}' for variable '{1}'".format(d, v))
+            index = tuple(index[d] for index, d in zip(indices, c))
+            array[index] = p
+            given[index[:-1]] = True
+        array[~given] = 1.0 / array.shape[-1]
+        return array
 
     def get_ancestors(self, variables):
         """Get all ancestors of the given variables.
@@ -110,14 +435,18 @@ class BayesNet(nx.DiGraph):
         -------
         A set with the ancestors.
         """
-        to_visit = set(variables)
-        ancestors = set()
-        while to_visit:
-            variable = to_visit.pop()
-            if variable not in ancestors:
-                ancestors.add(variable)
-                to_visit |= set(self.predecessors(variable))
-        return ancestors
+        self.build()
+        to_visit = np.array([self.node_id(v) for v in variables],
+                            dtype=np.int64)
+        ancestors = np.zeros(len(self.names), dtype=bool)
+        ancestors[to_visit] = True
+        # Visit the graph level by level, all nodes of a level at once.
+        while len(to_visit):
+            parents = np.unique(gather(self.parent_ptr, self.parent_idx,
+                                       to_visit))
+            to_visit = parents[~ancestors[parents]]
+            ancestors[to_visit] = True
+        return set(self.names[i] for i in np.flatnonzero(ancestors))
 
     def get_reachable(self, x, observed=None, plot=False):
         """Get all nodes that are reachable from x, given the observed nodes.
@@ -141,48 +470,49 @@ class BayesNet(nx.DiGraph):
         if observed is None:
             observed = []
         observed = set(observed)
-        assert x in self.nodes()
-        assert observed <= set(self.nodes())
+        assert x in self.ids
+        assert all(v in self.ids for v in observed)
+        n = len(self.names)
+        is_observed = np.zeros(n, dtype=bool)
+        is_observed[[self.ids[v] for v in observed]] = True
         # First, find all ancestors of observed set.
-        ancestors = self.get_ancestors(observed)
+        is_ancestor = np.zeros(n, dtype=bool)
+        is_ancestor[[self.ids[v] for v in self.get_ancestors(observed)]] = True
         # Then, perform a search for reachable variables starting from x.
-        # Nodes to be visited are stored as tuples with the following elements:
-        #         * the variable
-        #         * True, if the variable was reached via an incoming edge,
-        #           False, if it was reached via an outgoing edge.
-        # Any variable that is reached through an active path is stored in
+        # The search proceeds level by level and keeps two sets of nodes to
+        # be visited:
+        #         * up: nodes reached via an outgoing edge,
+        #         * down: nodes reached via an incoming edge.
+        # Any variable that is reached through an active path is marked in
         # reachable.
-        to_visit = set([(x, False)])
-        visited = set()
-        reachable = set()
-        while to_visit != set():
-            current = to_visit.pop()
-            variable, trail_entering = current
-            if current in visited:
-                continue
-            if variable not in observed:
-                reachable.add(variable)
-            visited.add(current)
-            # <--- V
-            if not trail_entering and variable not in observed:
-                # <--- V <---
-                for predecessor in self.predecessors(variable):
-                    to_visit.add((predecessor, False))
-                # <--- V --->
-                for successor in self.successors(variable):
-                    to_visit.add((successor, True))
-            # ---> V
-            elif trail_entering:
-                # ---> V --->
-                if variable not in observed:  # only successors blocked.
-                    for successor in self.successors(variable):
-                        to_visit.add((successor, True))
-                # ---> V <---
-                elif variable in ancestors:
-                    for predecessor in self.predecessors(variable):
-                        to_visit.add((predecessor, False))
+        up = np.array([self.ids[x]], dtype=np.int64)
+        down = np.zeros(0, dtype=np.int64)
+        visited_up = np.zeros(n, dtype=bool)
+        visited_down = np.zeros(n, dtype=bool)
+        reachable = np.zeros(n, dtype=bool)
+        self.build()
+        pp, pi = self.parent_ptr, self.parent_idx
+        cp, ci = self.child_ptr, self.child_idx
+        while len(up) or len(down):
+            up = np.unique(up[~visited_up[up]])
+            down = np.unique(down[~visited_down[down]])
+            visited_up[up] = True
+            visited_down[down] = True
+            reachable[up[~is_observed[up]]] = True
+            reachable[down[~is_observed[down]]] = True
+            # <--- V <---  and  <--- V --->
+            up_active = up[~is_observed[up]]
+            # ---> V --->  (only successors blocked)
+            down_active = down[~is_observed[down]]
+            # ---> V <---
+            down_vstruct = down[is_observed[down] & is_ancestor[down]]
+            up = np.concatenate([gather(pp, pi, up_active),
+                                 gather(pp, pi, down_vstruct)])
+            down = np.concatenate([gather(cp, ci, up_active),
+                                   gather(cp, ci, down_active)])
         # Just a convention to not return the query node.
-        reachable.discard(x)
+        reachable[self.ids[x]] = False
+        reachable = set(self.names[i] for i in np.flatnonzero(reachable))
         # Optionally plot.
         if plot:
             self.draw(x, observed, reachable)
@@ -202,8 +532,9 @@ class BayesNet(nx.DiGraph):
         dependent : iterable of str
             The variables which are dependent on ``x`` given ``observed``.
         """
-        pos = nx.spectral_layout(self)
-        nx.draw_networkx_edges(self, pos,
+        g = self.to_networkx()
+        pos = nx.spectral_layout(g)
+        nx.draw_networkx_edges(g, pos,
                                edge_color=EDGE_COLOR,
                                width=EDGE_WIDTH)
         if x or observed or dependent:
@@ -212,28 +543,57 @@ class BayesNet(nx.DiGraph):
         else:
             rest = self.nodes()
         if rest:
-            obj = nx.draw_networkx_nodes(self, pos, nodelist=rest,
+            obj = nx.draw_networkx_nodes(g, pos, nodelist=rest,
                                          node_size=NODE_SIZE,
                                          node_color=NODE_COLOR_NORMAL)
             obj.set_linewidth(NODE_BORDER_WIDTH)
             obj.set_edgecolor(NODE_BORDER_COLOR)
         if x:
-            obj = nx.draw_networkx_nodes(self, pos, nodelist=[x],
+            obj = nx.draw_networkx_nodes(g, pos, nodelist=[x],
                                          node_size=3000,
                                          node_color=NODE_COLOR_SOURCE,
                                          node_shape=NODE_SHAPE_SOURCE)
             obj.set_linewidth(NODE_BORDER_WIDTH)
             obj.set_edgecolor(NODE_BORDER_COLOR)
         if observed:
-            obj = nx.draw_networkx_nodes(self, pos, nodelist=list(observed),
+            obj = nx.draw_networkx_nodes(g, pos, nodelist=list(observed),
                                          node_size=NODE_SIZE,
                                          node_color=NODE_COLOR_OBSERVED)
             obj.set_linewidth(NODE_BORDER_WIDTH)
             obj.set_edgecolor(NODE_BORDER_COLOR)
         if dependent:
-            obj = nx.draw_networkx_nodes(self, pos, nodelist=list(dependent),
+            obj = nx.draw_networkx_nodes(g, pos, nodelist=list(dependent),
                                          node_size=NODE_SIZE,
                                          node_color=NODE_COLOR_REACHABLE)
             obj.set_linewidth(NODE_BORDER_WIDTH)
             obj.set_edgecolor(NODE_BORDER_COLOR)
-        nx.draw_networkx_labels(self, pos, font_color=LABEL_COLOR)
+        nx.draw_networkx_labels(g, pos, font_color=LABEL_COLOR)
+
+
+def csr(rows, cols, n):
+    """Lay out the edges ``rows[k] -> cols[k]`` of a graph with ``n`` nodes
+    in compressed sparse row form.
+
+    Returns
+    -------
+    A tuple ``(ptr, idx)``, s.t., ``idx[ptr[i]:ptr[i + 1]]`` are the columns
+    of all edges in row i, in the order of the edges.
+    """
+    order = np.argsort(rows, kind='stable')
+    ptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=n), out=ptr[1:])
+    return ptr, cols[order]
+
+
+def gather(ptr, idx, rows):
+    """Get the concatenated columns of the given ``rows`` of a graph in
+    compressed sparse row form (see ``csr``)."""
+    starts = ptr[rows]
+    lengths = ptr[rows + 1] - starts
+    total = lengths.sum()
+    if total == 0:
+        return np.zeros(0, dtype=np.int64)
+    # Position of each gathered element within the concatenation, shifted to
+    # the start of its row.
+    shift = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+    return idx[shift + np.arange(total)]
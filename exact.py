@@ -0,0 +1,553 @@
+import numpy as np
+import bprop
+
+
+HEURISTICS = ('min-degree', 'min-fill', 'weighted-min-fill')
+
+
+def cpt_factor(v):
+    """Convert the CPT of variable ``v`` to a factor.
+
+    A factor is a tuple ``(variables, table)``, where ``table`` is a dense
+    array in the log domain with one axis per variable in ``variables``,
+    indexed by the position of each value in the variable's domain.
+
+    Arguments
+    ---------
+    v : core.Variable
+        A variable with a CPT.
+    """
+    return (tuple(v.parents) + (v.name,), bprop.log(v.cpt))
+
+
+def align(factor, variables):
+    """Transpose and reshape the table of ``factor``, so that it broadcasts
+    against a table with the given ``variables`` as axes."""
+    fvars, table = factor
+    perm = sorted(range(len(fvars)), key=lambda i: variables.index(fvars[i]))
+    shape = [1] * len(variables)
+    for i in perm:
+        shape[variables.index(fvars[i])] = table.shape[i]
+    return np.reshape(np.transpose(table, perm), shape)
+
+
+def condition_factor(factor, observed):
+    """Restrict ``factor`` to the observed values of its variables.
+
+    Arguments
+    ---------
+    factor : tuple
+        The factor.
+
+    observed : dict
+        Maps observed variables to the index of their observed value.
+
+    Returns
+    -------
+    A factor over the unobserved variables of ``factor``.
+    """
+    fvars, table = factor
+    index = tuple(observed.get(v, slice(None)) for v in fvars)
+    return (tuple(v for v in fvars if v not in observed), table[index])
+
+
+def eliminate(factors, x):
+    """Multiply all factors that contain ``x`` and sum ``x`` out.
+
+    Returns
+    -------
+    The new list of factors.
+    """
+    involved = [f for f in factors if x in f[0]]
+    rest = [f for f in factors if x not in f[0]]
+    variables = []
+    for fvars, _ in involved:
+        variables.extend(v for v in fvars if v not in variables)
+    table = sum(align(f, variables) for f in involved)
+    table = bprop.logsumexp(table, axis=variables.index(x))
+    variables.remove(x)
+    rest.append((tuple(variables), np.asarray(table)))
+    return rest
+
+
+def interaction_graph(factors):
+    """Build the interaction graph of ``factors``.
+
+    Returns
+    -------
+    A dictionary that maps each variable to the set of variables it shares a
+    factor with.
+    """
+    adj = {}
+    for fvars, _ in factors:
+        for v in fvars:
+            adj.setdefault(v, set()).update(u for u in fvars if u != v)
+    return adj
+
+
+def elimination_order(adj, sizes, variables, heuristic='min-fill'):
+    """Greedily compute an elimination order for ``variables``.
+
+    At each step, the variable with the smallest cost according to
+    ``heuristic`` is eliminated, where the cost is
+
+        * 'min-degree': the number of neighbors of the variable,
+        * 'min-fill': the number of edges that have to be added among the
+          neighbors of the variable when eliminating it,
+        * 'weighted-min-fill': the sum of the weights of these edges, where
+          the weight of an edge is the product of the domain sizes of its end
+          points.
+
+    Ties are broken by variable name.
+
+    Arguments
+    ---------
+    adj : dict
+        The interaction graph as returned by ``interaction_graph``. It is not
+        modified.
+
+    sizes : dict
+        Domain size of each variable.
+
+    variables : iterable of str
+        The variables to eliminate.
+
+    heuristic : str
+        One of 'min-degree', 'min-fill', 'weighted-min-fill'.
+
+    Returns
+    -------
+    A tuple of the elimination order and a list with the variables of the
+    table created at each elimination step (the variable itself and its
+    neighbors at that time).
+    """
+    if heuristic not in HEURISTICS:
+        raise RuntimeError("Unknown heuristic '{0}'".format(heuristic))
+    adj = {v: set(ns) for v, ns in adj.items()}
+    for v in variables:
+        adj.setdefault(v, set())
+
+    def cost(v):
+        if heuristic == 'min-degree':
+            return len(adj[v])
+        ns = sorted(adj[v])
+        fill = [(a, b) for i, a in enumerate(ns) for b in ns[i + 1:]
+                if b not in adj[a]]
+        if heuristic == 'min-fill':
+            return len(fill)
+        return sum(sizes[a] * sizes[b] for a, b in fill)
+
+    remaining = set(variables)
+    order = []
+    cliques = []
+    while remaining:
+        v = min(sorted(remaining), key=cost)
+        ns = adj.pop(v)
+        for u in ns:
+            adj[u].discard(v)
+            adj[u] |= ns - set([u])
+        remaining.remove(v)
+        order.append(v)
+        cliques.append([v] + sorted(ns))
+    return order, cliques
+
+
+class EliminationPlan(object):
+    """The elimination order for a query together with its cost estimate.
+
+    Attributes
+    ----------
+    order : list of str
+        The order in which variables are eliminated.
+
+    cliques : list of list of str
+        The variables of the table created at each elimination step.
+
+    table_sizes : list of int
+        The number of entries of the table created at each elimination step.
+
+    width : int
+        The induced width of the order (size of largest clique minus one).
+    """
+
+    def __init__(self, order, cliques, sizes):
+        self.order = order
+        self.cliques = cliques
+        self.table_sizes = [int(np.prod([sizes[v] for v in c]))
+                            for c in cliques]
+        self.width = max([len(c) for c in cliques] or [1]) - 1
+
+    @property
+    def max_table_size(self):
+        return max(self.table_sizes or [0])
+
+    @property
+    def total_table_size(self):
+        return sum(self.table_sizes)
+
+
+class VariableElimination(object):
+    """Exact inference on a ``core.BayesNet`` by variable elimination."""
+
+    def __init__(self, bn):
+        self.bn = bn
+        self.vs = bn.vs
+
+    def relevant_factors(self, query, observations):
+        """Get the CPT factors relevant to the query, conditioned on the
+        observations.
+
+        Only the ancestors of query and observed variables are relevant; all
+        other variables are barren and sum out to one.
+        """
+        unknown_vars = (set(query) | set(observations)) - set(self.vs)
+        if unknown_vars != set():
+            raise RuntimeError("Unknown variable '{0}'".format(
+                unknown_vars.pop()))
+        observed = {v: list(self.vs[v].domain).index(value)
+                    for v, value in observations.items()}
+        relevant = self.bn.get_ancestors(set(query) | set(observations))
+        return [condition_factor(cpt_factor(self.vs[v]), observed)
+                for v in sorted(relevant)]
+
+    def plan(self, variable, observations=None, heuristic='min-fill'):
+        """Compute the elimination plan for the marginal of ``variable``.
+
+        Arguments
+        ---------
+        variable : str
+            The query variable.
+
+        observations : dict of variable -> value
+            The observed values of one or more variables.
+
+        heuristic : str
+            The elimination order heuristic. See ``elimination_order``.
+
+        Returns
+        -------
+        An ``EliminationPlan``.
+        """
+        if observations is None:
+            observations = {}
+        factors = self.relevant_factors([variable], observations)
+        return self.plan_factors(factors, variable, heuristic)
+
+    def plan_factors(self, factors, variable, heuristic):
+        """Compute the plan for eliminating all variables of ``factors``
+        except ``variable``."""
+        adj = interaction_graph(factors)
+        sizes = {v: len(self.vs[v].domain) for v in adj}
+        to_eliminate = [v for v in adj if v != variable]
+        order, cliques = elimination_order(adj, sizes, to_eliminate,
+                                           heuristic)
+        return EliminationPlan(order, cliques, sizes)
+
+    def query(self, variables, observations=None, heuristic='min-fill',
+              max_table_size=None):
+        """Compute the exact marginal of each query variable.
+
+        The elimination plans for all query variables are computed first. If
+        any of them would create a table with more than ``max_table_size``
+        entries, no elimination is performed at all.
+
+        Arguments
+        ---------
+        variables : iterable of str
+            The query variables.
+
+        observations : dict of variable -> value
+            The observed values of one or more variables.
+
+        heuristic : str
+            The elimination order heuristic. See ``elimination_order``.
+
+        max_table_size : int
+            Maximum allowed number of entries of an intermediate table.
+            Defaults to None (no limit).
+
+        Returns
+        -------
+        An ``bprop.InferenceResult`` containing (1) a dictionary that maps
+        each query variable to a 1 x |domain| array with its marginal, (2) the
+        domain of each query variable, and (3) the observations. The plan used
+        for each variable is available as the ``plans`` attribute.
+        """
+        if isinstance(variables, str):
+            variables = [variables]
+        if observations is None:
+            observations = {}
+        factors = {}
+        plans = {}
+        for v in variables:
+            if v in observations:
+                continue
+            factors[v] = self.relevant_factors([v], observations)
+            plans[v] = self.plan_factors(factors[v], v, heuristic)
+            if (max_table_size is not None and
+                    plans[v].max_table_size > max_table_size):
+                raise RuntimeError(
+                    "Query for '{0}' requires a table of {1} entries".format(
+                        v, plans[v].max_table_size))
+        marg = {}
+        for v in variables:
+            if v in observations:
+                m = np.zeros(len(self.vs[v].domain))
+                m[list(self.vs[v].domain).index(observations[v])] = 1
+            else:
+                vfactors = factors[v]
+                for x in plans[v].order:
+                    vfactors = eliminate(vfactors, x)
+                table = sum(align(f, [v]) for f in vfactors if f[0])
+                m = np.exp(bprop.normalize(table))
+            marg[v] = m[np.newaxis]
+        domains = {v: self.vs[v].domain for v in variables}
+        return bprop.InferenceResult(marg, domains, observations,
+                                     plans=plans)
+
+
+class JunctionTree(object):
+    """Exact inference on a ``core.BayesNet`` with a junction tree.
+
+    The network is compiled once into a tree of cliques (obtained from an
+    elimination order of its moral graph), each holding the product of the
+    CPTs assigned to it. Queries are answered by Shafer-Shenoy message
+    passing, that is, a collect and a distribute pass over the tree. Messages
+    are cached between queries; when observations change, only messages that
+    depend on the changed cliques are recomputed.
+    """
+
+    def __init__(self, bn, heuristic='min-fill'):
+        """
+        Arguments
+        ---------
+        bn : core.BayesNet
+            The network to compile. Every variable must have a CPT.
+
+        heuristic : str
+            The elimination order heuristic used for triangulation. See
+            ``elimination_order``.
+        """
+        self.vs = bn.vs
+        self.domains = {v.name: v.domain for v in bn.vs.values()}
+        factors = [cpt_factor(v) for v in bn.vs.values()]
+        adj = interaction_graph(factors)
+        sizes = {v: len(d) for v, d in self.domains.items()}
+        order, cliques = elimination_order(adj, sizes, list(self.domains),
+                                           heuristic)
+        position = {v: i for i, v in enumerate(order)}
+        # The parent of the clique created by eliminating v is the clique of
+        # the first eliminated variable among the other clique members.
+        parent = [min([position[u] for u in c[1:]]) if len(c) > 1 else None
+                  for c in cliques]
+        # Merge cliques into their children if they are subsets of them.
+        alias = list(range(len(cliques)))
+
+        def find(i):
+            while alias[i] != i:
+                i = alias[i]
+            return i
+
+        for i in range(len(cliques)):
+            if alias[i] != i:
+                continue
+            while parent[i] is not None:
+                p = find(parent[i])
+                if not set(cliques[p]) <= set(cliques[i]):
+                    parent[i] = p
+                    break
+                alias[p] = i
+                parent[i] = parent[p]
+        kept = [i for i in range(len(cliques)) if alias[i] == i]
+        newid = {i: k for k, i in enumerate(kept)}
+        edges = [(newid[i], newid[find(parent[i])]) for i in kept
+                 if parent[i] is not None]
+        cliques = [tuple(cliques[i]) for i in kept]
+        # Assign each CPT to the clique of its first eliminated variable.
+        potentials = [np.zeros([sizes[v] for v in c]) for c in cliques]
+        for f in factors:
+            k = newid[find(min(position[v] for v in f[0]))]
+            potentials[k] = potentials[k] + align(f, list(cliques[k]))
+        self.setup(self.domains, cliques, edges, potentials)
+
+    def setup(self, domains, cliques, edges, potentials):
+        """Set the compiled tree, together with all state that is derived
+        from it, and clear the observations and the cached messages.
+
+        Arguments
+        ---------
+        domains : dict
+            Maps each variable to its domain.
+
+        cliques : list of tuple
+            The variables of each clique.
+
+        edges : list of tuple
+            The pairs of neighboring cliques.
+
+        potentials : list of array
+            The log-potential of each clique, with one axis per clique
+            variable.
+        """
+        self.domains = domains
+        self.orig2new = {v: {d: i for i, d in enumerate(domain)}
+                         for v, domain in domains.items()}
+        self.cliques = cliques
+        self.neighbors = [[] for _ in cliques]
+        for i, j in edges:
+            self.neighbors[i].append(j)
+            self.neighbors[j].append(i)
+        # The home clique of a variable is the first clique containing it.
+        self.home = {}
+        for k, c in enumerate(self.cliques):
+            for v in c:
+                self.home.setdefault(v, k)
+        self.potentials = potentials
+        self.evidence = [np.zeros(p.shape) for p in self.potentials]
+        self.vobs = {}
+        self.messages = {}
+        self.nupdates = 0
+
+    def edges(self):
+        """Get the pairs ``(i, j)`` of neighboring cliques with ``i < j``."""
+        return [(i, j) for i in range(len(self.cliques))
+                for j in self.neighbors[i] if i < j]
+
+    def invalidate(self, k):
+        """Drop all cached messages that depend on clique ``k``, i.e., all
+        messages sent away from ``k``."""
+        to_visit = [(k, None)]
+        while to_visit:
+            i, prev = to_visit.pop()
+            for j in self.neighbors[i]:
+                if j != prev:
+                    self.messages.pop((i, j), None)
+                    to_visit.append((j, i))
+
+    def set_evidence(self, k):
+        """Recompute the evidence potential of clique ``k`` from the current
+        observations."""
+        c = self.cliques[k]
+        ev = np.zeros_like(self.potentials[k])
+        for axis, v in enumerate(c):
+            if v in self.vobs and self.home[v] == k:
+                table = np.full(len(self.domains[v]), bprop.LOG_ZERO)
+                table[self.orig2new[v][self.vobs[v]]] = 0
+                ev = ev + bprop.expand(table, axis, len(c))
+        self.evidence[k] = ev
+        self.invalidate(k)
+
+    def condition(self, observations):
+        """Condition on the given observations.
+
+        For every ``(variable, value)`` pair in ``observations``, the
+        condition that ``variable`` is equal to ``value`` is added to the
+        existing observations, replacing any previous observation of the same
+        variable.
+
+        Arguments
+        ---------
+        observations: dict of variable -> value
+            The observed values for one or more variables.
+        """
+        unknown_vars = set(observations.keys()) - set(self.domains.keys())
+        if unknown_vars != set():
+            raise RuntimeError("Unknown variable '{0}'".format(
+                unknown_vars.pop()))
+        changed = set()
+        for name, value in observations.items():
+            if name not in self.vobs or self.vobs[name] != value:
+                self.vobs[name] = value
+                changed.add(self.home[name])
+        for k in changed:
+            self.set_evidence(k)
+
+    def retract(self, variables):
+        """Remove the observations of the given variables (if any)."""
+        changed = set()
+        for name in variables:
+            if name in self.vobs:
+                del self.vobs[name]
+                changed.add(self.home[name])
+        for k in changed:
+            self.set_evidence(k)
+
+    def message(self, i, j):
+        """Get the message from clique ``i`` to neighboring clique ``j``,
+        computing it and any missing messages it depends on."""
+        to_compute = [(i, j)]
+        while to_compute:
+            i, j = to_compute[-1]
+            if (i, j) in self.messages:
+                to_compute.pop()
+                continue
+            missing = [(k, i) for k in self.neighbors[i]
+                       if k != j and (k, i) not in self.messages]
+            if missing:
+                to_compute.extend(missing)
+                continue
+            to_compute.pop()
+            c = self.cliques[i]
+            table = self.belief(i, exclude=j)
+            sep = [v for v in c if v in self.cliques[j]]
+            axes = tuple(a for a, v in enumerate(c) if v not in sep)
+            self.messages[(i, j)] = (tuple(sep),
+                                     bprop.logsumexp(table, axis=axes))
+            self.nupdates += 1
+        return self.messages[(i, j)]
+
+    def belief(self, k, exclude=None):
+        """Compute the unnormalized log-belief of clique ``k`` from all
+        incoming messages except the one from ``exclude``."""
+        c = list(self.cliques[k])
+        table = self.potentials[k] + self.evidence[k]
+        for i in self.neighbors[k]:
+            if i != exclude:
+                table = table + align(self.message(i, k), c)
+        return table
+
+    def calibrate(self):
+        """Compute all messages that are not cached (collect and distribute
+        pass).
+
+        Returns
+        -------
+        The number of recomputed messages.
+        """
+        self.nupdates = 0
+        for i in range(len(self.cliques)):
+            for j in self.neighbors[i]:
+                self.message(i, j)
+        return self.nupdates
+
+    def query(self, variables=None):
+        """Compute the exact marginals of the given variables.
+
+        Arguments
+        ---------
+        variables : iterable of str
+            The query variables. Defaults to None (all variables).
+
+        Returns
+        -------
+        An ``bprop.InferenceResult`` containing (1) a dictionary that maps
+        each query variable to a 1 x |domain| array with its marginal, (2) the
+        domain of each query variable, and (3) the observations. The number of
+        messages that had to be recomputed is available as the ``nupdates``
+        attribute.
+        """
+        if variables is None:
+            variables = list(self.domains)
+        elif isinstance(variables, str):
+            variables = [variables]
+        self.nupdates = 0
+        marg = {}
+        for v in variables:
+            k = self.home[v]
+            c = self.cliques[k]
+            axes = tuple(a for a, u in enumerate(c) if u != v)
+            table = bprop.logsumexp(self.belief(k), axis=axes)
+            marg[v] = np.exp(bprop.normalize(table))[np.newaxis]
+        domains = {v: self.domains[v] for v in variables}
+        return bprop.InferenceResult(marg, domains, dict(self.vobs),
+                                     nupdates=self.nupdates)
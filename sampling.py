@@ -1,6 +1,26 @@
+import multiprocessing
+import networkx as nx
 import numpy as np
 import numpy.random as npr
 import bprop
+import exact
+
+
+# Number of sweeps for which random numbers are drawn at once.
+SWEEP_BLOCK = 1024
+
+# Default length of the thinned trajectories that ``run_chains`` keeps for
+# its diagnostics when the samples are not recorded.
+TRACE_LENGTH = 1000
+
+# Minimum number of batch means that ``run_adaptive`` keeps of its chain.
+BATCHES = 32
+
+# Attributes of a ``GibbsSampler`` that ``run_sweeps`` needs. Only these are
+# sent to the worker processes of ``run_chains``.
+SWEEP_STATE = ('names', 'index', 'dsize', 'domains', 'vobs', 'observed',
+               'free', 'blankets', 'mb', 'strides', 'offset', 'slices',
+               'cond', 'cdf', 'classes')
 
 
 def cumulative_average(array, step=1):
@@ -24,22 +44,245 @@ def cumulative_average(array, step=1):
     return avg
 
 
+def gelman_rubin(chains):
+    """Compute the Gelman-Rubin potential scale reduction factor (R-hat).
+
+    Arguments
+    ---------
+    chains : array
+        A K x N array with N scalar samples from each of K chains.
+
+    Returns
+    -------
+    The R-hat value. Values close to 1 indicate that the chains have mixed.
+    """
+    chains = np.asarray(chains, dtype=float)
+    n = chains.shape[1]
+    within = np.mean(np.var(chains, axis=1, ddof=1))
+    between = np.var(np.mean(chains, axis=1), ddof=1)
+    if within == 0:
+        return 1.0 if between == 0 else np.inf
+    var_hat = (n - 1.0) / n * within + between
+    return np.sqrt(var_hat / within)
+
+
+def effective_sample_size(chains):
+    """Compute the effective sample size of a set of chains.
+
+    The autocorrelations are estimated over all chains (via FFT) and summed
+    up using Geyer's initial positive sequence estimator.
+
+    Arguments
+    ---------
+    chains : array
+        A K x N array with N scalar samples from each of K chains.
+
+    Returns
+    -------
+    The effective number of independent samples in all chains together.
+    """
+    chains = np.asarray(chains, dtype=float)
+    k, n = chains.shape
+    centered = chains - np.mean(chains, axis=1)[:, np.newaxis]
+    nfft = 1 << int(2 * n - 1).bit_length()
+    f = np.fft.rfft(centered, nfft, axis=1)
+    autocov = np.fft.irfft(f * np.conj(f), nfft, axis=1)[:, :n] / n
+    within = np.mean(autocov[:, 0]) * n / max(n - 1.0, 1)
+    var_hat = within * (n - 1.0) / n
+    if k > 1:
+        var_hat += np.var(np.mean(chains, axis=1), ddof=1)
+    if var_hat == 0:
+        return float(k * n)
+    rho = 1 - (within - np.mean(autocov, axis=0)) / var_hat
+    rho[0] = 1
+    # Sum pairs of consecutive autocorrelations while they are positive.
+    total = 0.0
+    for t in range(0, n - 1, 2):
+        pair = rho[t] + rho[t + 1]
+        if pair < 0:
+            break
+        total += pair
+    tau = max(2 * total - 1, 1.0 / np.log10(max(k * n, 10)))
+    return k * n / tau
+
+
+def geweke(x, first=0.1, last=0.5):
+    """Compute the Geweke convergence z-score of a chain.
+
+    The mean of the first ``first`` fraction of the chain is compared to the
+    mean of its last ``last`` fraction. The variance of each mean is
+    estimated from the effective sample size of the segment, to account for
+    autocorrelation.
+
+    Arguments
+    ---------
+    x : array
+        A chain of N scalar samples.
+
+    Returns
+    -------
+    The z-score. Absolute values larger than about 2 indicate that the
+    beginning of the chain has not converged yet.
+    """
+    x = np.asarray(x, dtype=float)
+    n = len(x)
+    a = x[:max(int(first * n), 2)]
+    b = x[n - max(int(last * n), 2):]
+    var = (np.var(a, ddof=1) / effective_sample_size(a[np.newaxis]) +
+           np.var(b, ddof=1) / effective_sample_size(b[np.newaxis]))
+    diff = np.mean(a) - np.mean(b)
+    if var == 0:
+        return 0.0 if diff == 0 else np.inf
+    return diff / np.sqrt(var)
+
+
+def state_dtype(dsize):
+    """Get the smallest integer type that can hold value indices for the
+    given domain sizes."""
+    dmax = max(dsize) if len(dsize) else 1
+    if dmax <= np.iinfo(np.int8).max + 1:
+        return np.int8
+    if dmax <= np.iinfo(np.int16).max + 1:
+        return np.int16
+    return np.int32
+
+
+def run_chain(args):
+    """Run one chain of ``GibbsSampler.run_chains`` with its own seed and
+    return its result."""
+    sampler, seed, kwargs = args
+    return sampler.run_sweeps(rng=npr.RandomState(seed), **kwargs)
+
+
 class GibbsSampler:
-    def __init__(self, fgraph):
+    def __init__(self, fgraph, max_table_size=10**6, max_total_size=10**7):
+        """
+        Arguments
+        ---------
+        fgraph : bprop.FactorGraph
+            The factor graph to sample from.
+
+        max_table_size : int
+            Maximum number of entries of the precomputed conditional table of
+            a variable. See ``precompute``.
+
+        max_total_size : int
+            Maximum number of entries of all precomputed conditional tables
+            together. See ``precompute``.
+        """
         self.fgraph = fgraph
+        self.max_table_size = max_table_size
+        self.max_total_size = max_total_size
         self.update_fgraph()
 
     def update_fgraph(self):
         """Should be called when the associated factor graph is updated."""
         self.vs = self.fgraph.vs
         self.vobs = self.fgraph.vobs
+        self.precompute()
+
+    def precompute(self):
+        """Precompute the posterior of every variable given its Markov
+        blanket.
+
+        For each variable v, the sum of the log-tables of all factors that
+        are neighbors of v is tabulated with one axis per Markov blanket
+        variable and a last axis for v. The normalized conditionals are then
+        stored as rows of a single table ``self.cond`` of shape R x D, where
+        D is the largest domain size. The row of v for a given Markov blanket
+        state is
+
+            self.offset[i] + sum_k state[self.mb[i, k]] * self.strides[i, k],
+
+        where i is the index of v in ``self.names``. ``self.cdf`` holds the
+        cumulative sums of the rows, so that sampling v amounts to one table
+        lookup and one search in the CDF.
+
+        Observed variables are clamped to their observed values: they are
+        not tabulated, and the factors are conditioned on them, so they do
+        not appear in the Markov blanket of any other variable. The indices of
+        the variables that are actually sampled are stored in ``self.free``.
+
+        Tables are built for the variables with the smallest tables first.
+        Variables whose table would have more than ``self.max_table_size``
+        entries, or would make ``self.cond`` exceed ``self.max_total_size``
+        entries, are not tabulated (their offset is -1). For each such
+        variable, ``self.slices[i]`` instead holds its neighboring factors as
+        pairs of the indices of their other variables and their log-tables
+        with the axis of v last. At sampling time, the tables are indexed by
+        the current state and the slices are summed, see ``conditional``.
+
+        The indices of the Markov blanket variables of every variable,
+        tabulated or not, are stored in ``self.blankets``.
+        """
+        self.names = list(self.vs.keys())
+        self.index = {v: i for i, v in enumerate(self.names)}
+        self.domains = {v: self.vs[v].orig_domain for v in self.names}
+        self.classes = None
+        n = len(self.names)
+        self.dsize = np.array([len(self.vs[v].domain) for v in self.names],
+                              dtype=int)
+        dmax = max(self.dsize) if n else 0
+        self.observed = {v: self.vs[v].orig2new[value]
+                         for v, value in self.vobs.items()}
+        self.free = np.array([i for i, v in enumerate(self.names)
+                              if v not in self.observed], dtype=int)
+        blankets = []
+        for v in self.names:
+            mb = []
+            for fnode in self.vs[v].neighbors:
+                mb.extend(u for u in fnode.variables
+                          if u != v and u not in mb and u not in self.observed)
+            blankets.append(mb)
+        self.blankets = [np.array([self.index[u] for u in mb], dtype=int)
+                         for mb in blankets]
+        kmax = max([len(mb) for mb in blankets] or [0])
+        self.mb = np.zeros((n, kmax), dtype=int)
+        self.strides = np.zeros((n, kmax), dtype=int)
+        self.offset = np.full(n, -1, dtype=int)
+        self.slices = [[] for _ in range(n)]
+        rows = []
+        nrows = 0
+        sizes = [int(np.prod([len(self.vs[u].domain) for u in blankets[i]]))
+                 for i in range(n)]
+        for i in sorted(self.free, key=lambda i: sizes[i]):
+            v = self.names[i]
+            mb = blankets[i]
+            factors = [exact.condition_factor((fnode.variables, fnode.table),
+                                              self.observed)
+                       for fnode in self.vs[v].neighbors]
+            if (sizes[i] * self.dsize[i] > self.max_table_size or
+                    (nrows + sizes[i]) * dmax > self.max_total_size):
+                for fvars, table in factors:
+                    axis = fvars.index(v)
+                    ids = np.array([self.index[u] for u in fvars if u != v],
+                                   dtype=int)
+                    self.slices[i].append((ids, np.moveaxis(table, axis, -1)))
+                continue
+            shape = [len(self.vs[u].domain) for u in mb] + [self.dsize[i]]
+            table = np.zeros(shape)
+            for factor in factors:
+                table = table + exact.align(factor, mb + [v])
+            table = np.exp(table - bprop.logsumexp(table, axis=-1)[..., None])
+            table = table.reshape((-1, self.dsize[i]))
+            rows.append(np.pad(table, ((0, 0), (0, dmax - self.dsize[i])),
+                               'constant'))
+            stride = 1
+            for k in reversed(range(len(mb))):
+                self.mb[i, k] = self.index[mb[k]]
+                self.strides[i, k] = stride
+                stride *= shape[k]
+            self.offset[i] = nrows
+            nrows += len(table)
+        self.cond = np.concatenate(rows) if rows else np.zeros((0, dmax))
+        self.cdf = np.cumsum(self.cond, axis=1)
+        self.cdf /= self.cdf[:, -1:]
 
     def condition(self, observations):
         """Convenience method. Same as ``bprob.FactorGraph.condition``."""
         self.fgraph.condition(observations)
         self.update_fgraph()
 
-    # NOTE: We could precompute/memoize the posteriors for more efficiency.
     def sample_var(self, v, state):
         """Sample a value of variable ``v`` from its posterior given ``state``.
 
@@ -59,6 +302,15 @@ class GibbsSampler:
         -------
         A randomly sampled value of ``v`` from the posterior P(v | state\{v}).
         """
+        if v in self.observed:
+            return self.observed[v]
+        i = self.index[v]
+        if self.offset[i] >= 0:
+            row = self.offset[i]
+            for u, stride in zip(self.mb[i], self.strides[i]):
+                row += state[self.names[u]] * stride
+            d = np.searchsorted(self.cdf[row], npr.rand(), side='right')
+            return min(d, self.dsize[i] - 1)
         v_domain = self.vs[v].domain
         prob = np.zeros(len(v_domain))
         for d in v_domain:
@@ -76,12 +328,37 @@ class GibbsSampler:
         prob = bprop.normalize(prob)
         return npr.choice(v_domain, p=np.exp(prob))
 
-    def run(self, niter, burnin=0, step=1, init_state=None):
+    def conditional(self, i, state):
+        """Compute the posterior of the untabulated variable with index ``i``
+        given the integer state array ``state`` from its factor slices.
+
+        Returns
+        -------
+        The normalized conditional distribution as an array of probabilities.
+        """
+        logp = np.zeros(self.dsize[i])
+        for ids, table in self.slices[i]:
+            logp += table[tuple(state[ids])]
+        p = np.exp(logp - np.max(logp))
+        return p / np.sum(p)
+
+    def draw(self, i, state, u):
+        """Resample the untabulated variable with index ``i`` in ``state``
+        using the uniform random number ``u``."""
+        d = np.searchsorted(np.cumsum(self.conditional(i, state)), u,
+                            side='right')
+        state[i] = min(d, self.dsize[i] - 1)
+
+    def run(self, niter, burnin=0, step=1, init_state=None, record='full'):
         """Run a Gibbs sampler to estimate marginals using ``niter`` samples.
 
         Optionally, use a burn-in period during which samples are discarded,
         and specify (part of) the starting state.
 
+        The samples are not stored. Running counts of the values of each
+        variable are kept instead, and the marginals are checkpointed
+        according to ``record``, as in ``run_sweeps``.
+
         Arguments
         ---------
         niter : int
@@ -100,32 +377,589 @@ class GibbsSampler:
             Starting state. Can be specified partially by only providing
             initial values for a subset of all variables.
 
+        record : str or int
+            Either 'full' (the marginals after every recorded sample),
+            'final', or an int k (the marginals after every k recorded
+            samples, and at the end). See ``bprop.MarginalHistory``. Defaults
+            to 'full'.
+
         Returns
         -------
         A tuple of computed marginals, variable domains, and observations,
         same as that returned by ``bprob.FactorGraph.run_bp``.
         """
         assert burnin < niter
-        variables = self.vs.keys()
-        samples = {v: [] for v in variables}
+        variables = list(self.vs.keys())
+        ids = np.array([self.index[v] for v in variables], dtype=int)
+        counts = np.zeros((len(self.names), max(self.dsize)), dtype=np.int64)
+        history = bprop.MarginalHistory(self.names, self.dsize,
+                                        (niter + step - 1) // step, record)
+        k = 0
         # If not specified, the initial value of each variable is drawn
-        # uniformly at random.
+        # uniformly at random. Observed variables are clamped to their
+        # observed values and never resampled.
         state = {v: npr.choice(vnode.domain) for v, vnode in self.vs.items()}
         if init_state is not None:
             state.update(init_state)
+        state.update(self.observed)
+        free = [v for v in variables if v not in self.observed]
         n_iterations = niter + burnin
-        variable = npr.choice(variables)
         for it in range(n_iterations):
-            variable = npr.choice(variables)
-            state[variable] = self.sample_var(variable, state)
+            # If all variables are observed, the state stays clamped.
+            if free:
+                variable = free[npr.randint(len(free))]
+                state[variable] = self.sample_var(variable, state)
             # Ignore burnin samples, otherwise take every ``step``-th sample.
             if it >= burnin and (it - burnin) % step == 0:
-                for v in variables:
-                    samples[v].append(state[v])
-        marginals = self.get_marginals(samples)
+                counts[ids, [state[v] for v in variables]] += 1
+                k += 1
+                history.update(k, lambda: counts / float(k))
+        marginals = history.result(k, lambda: counts / float(k))
         domains = {v.name: v.orig_domain for v in self.vs.values()}
         return (marginals, domains, self.fgraph.vobs)
 
+    def color_classes(self):
+        """Color the interaction graph of the variables, in which two
+        variables are adjacent if one is in the Markov blanket of the other.
+
+        Variables of the same color are conditionally independent given all
+        other variables, so they can be resampled simultaneously.
+
+        The coloring is computed once and cached until the next
+        ``precompute``.
+
+        Returns
+        -------
+        A list of integer arrays, each holding the indices (into
+        ``self.names``) of the variables of one color.
+        """
+        if self.classes is not None:
+            return self.classes
+        g = nx.Graph()
+        g.add_nodes_from(self.free)
+        for i in self.free:
+            g.add_edges_from((i, u) for u in self.blankets[i])
+        coloring = nx.greedy_color(g, strategy='largest_first')
+        ncolors = max(coloring.values()) + 1 if coloring else 0
+        self.classes = [
+            np.array(sorted(i for i, c in coloring.items() if c == color),
+                     dtype=int)
+            for color in range(ncolors)]
+        return self.classes
+
+    def detach(self):
+        """Get a copy of the sampler that only holds the precomputed tables
+        needed by ``run_sweeps``, without the factor graph, so that it is
+        cheap to send to other processes."""
+        copy = GibbsSampler.__new__(GibbsSampler)
+        for attr in SWEEP_STATE:
+            setattr(copy, attr, getattr(self, attr))
+        return copy
+
+    def run_sweeps(self, nsweeps, burnin=0, step=1, init_state=None,
+                   chromatic=False, record='full', rao_blackwell=False,
+                   thin=None, rng=None):
+        """Run a systematic-scan Gibbs sampler on an integer state array.
+
+        In each sweep every variable is resampled once, in the order of
+        ``self.names``, using the tables built by ``precompute``. The state is
+        a NumPy array of value indices, the uniform random numbers of each
+        sweep are drawn in advance, and the recorded states are written to a
+        preallocated matrix of small integers. Variables without a table are
+        resampled from their factor slices, see ``conditional``.
+
+        If ``chromatic`` is True, the variables are instead partitioned by
+        ``color_classes`` and a sweep resamples all variables of one color at
+        once with a few array operations, one color after the other.
+
+        Unless ``record`` is 'full', the recorded states are not stored at
+        all. Instead, running counts of the values of each variable are kept
+        and the marginals are checkpointed according to ``record``, so that
+        memory does not grow with the number of sweeps. If ``thin`` is given,
+        every ``thin``-th recorded state is additionally kept in a
+        preallocated trajectory.
+
+        If ``rao_blackwell`` is True, the marginals are estimated by averaging
+        the full conditional distribution of every variable given its Markov
+        blanket at each recorded sweep, instead of the indicators of its
+        sampled values. The conditionals are looked up in the same table
+        ``self.cond`` that is used for sampling (or computed from the factor
+        slices of untabulated variables), and the resulting estimates have
+        lower variance for the same number of sweeps.
+
+        Arguments
+        ---------
+        nsweeps : int
+            Number of sweeps after the burn-in period.
+
+        burnin : int
+            Number of sweeps whose samples are discarded.
+
+        step : int
+            Only every ``step``-th sweep is recorded. See ``run``.
+
+        init_state : dict
+            Starting state (value indices). Can be specified partially.
+
+        chromatic : bool
+            Whether to use block updates of conditionally independent
+            variables. Defaults to False.
+
+        record : str or int
+            Either 'full' (store all recorded states), 'final' (only keep
+            counts and return the final marginals), or an int k (only keep
+            counts and return the marginals after every k recorded samples,
+            and at the end). See ``bprop.MarginalHistory``. Defaults to
+            'full'.
+
+        rao_blackwell : bool
+            Whether to use the Rao-Blackwellized estimator of the marginals.
+            Defaults to False.
+
+        thin : int
+            If given, keep the recorded states 0, k, 2k, ... for k = ``thin``
+            as a thinned trajectory. Defaults to None.
+
+        rng : numpy.random.RandomState
+            Source of random numbers. Defaults to None (the global NumPy
+            random state).
+
+        Returns
+        -------
+        A ``bprop.InferenceResult`` with the computed marginals (one row per
+        recorded sweep or checkpoint), variable domains, and observations,
+        same as ``run``. The recorded states are available as the ``samples``
+        attribute, an N x n array whose columns are ordered as ``self.names``
+        (None, unless ``record`` is 'full'), and the thinned trajectory as the
+        ``trajectory`` attribute, a ceil(N / ``thin``) x n array (None, unless
+        ``thin`` is given). The final state is available as the ``state``
+        attribute.
+        """
+        if rng is None:
+            rng = npr
+        n = len(self.names)
+        state = self.init_state(init_state, rng)
+        nsamples = (nsweeps + step - 1) // step
+        if record == 'full':
+            samples = np.empty((nsamples, n), dtype=self.state_dtype())
+        else:
+            samples = None
+        if thin is not None:
+            trajectory = np.empty(((nsamples + thin - 1) // thin, n),
+                                  dtype=self.state_dtype())
+        else:
+            trajectory = None
+        if samples is None or rao_blackwell:
+            counts = np.zeros((n, max(self.dsize)),
+                              dtype=float if rao_blackwell else np.int64)
+            history = bprop.MarginalHistory(self.names, self.dsize, nsamples,
+                                            record)
+        variables = np.arange(n)
+        free = self.free
+        clamped = np.setdiff1d(variables, free)
+        tabulated = free[self.offset[free] >= 0]
+        untabulated = free[self.offset[free] < 0]
+        mb = [self.mb[i] for i in range(n)]
+        strides = [self.strides[i] for i in range(n)]
+        # Split every color into its tabulated and untabulated variables.
+        colors = [(c[self.offset[c] >= 0], c[self.offset[c] < 0])
+                  for c in (self.color_classes() if chromatic else [])]
+        k = 0
+        total = burnin + nsweeps
+        for sweep in range(total):
+            # Draw the random numbers for blocks of sweeps at once.
+            if sweep % SWEEP_BLOCK == 0:
+                uniform = rng.rand(min(SWEEP_BLOCK, total - sweep), n)
+            u = uniform[sweep % SWEEP_BLOCK]
+            if chromatic:
+                for c, slow in colors:
+                    rows = self.offset[c] + np.sum(
+                        state[self.mb[c]] * self.strides[c], axis=1)
+                    state[c] = np.sum(self.cdf[rows] <= u[c, np.newaxis],
+                                      axis=1)
+                    for i in slow:
+                        self.draw(i, state, u[i])
+            else:
+                for i in self.free:
+                    if self.offset[i] < 0:
+                        self.draw(i, state, u[i])
+                        continue
+                    row = self.offset[i] + np.dot(state[mb[i]], strides[i])
+                    state[i] = np.searchsorted(self.cdf[row], u[i],
+                                               side='right')
+            if sweep >= burnin and (sweep - burnin) % step == 0:
+                if samples is not None:
+                    samples[k] = state
+                if trajectory is not None and k % thin == 0:
+                    trajectory[k // thin] = state
+                if rao_blackwell:
+                    rows = self.offset[tabulated] + np.sum(
+                        state[self.mb[tabulated]] * self.strides[tabulated],
+                        axis=1)
+                    counts[tabulated] += self.cond[rows]
+                    for i in untabulated:
+                        counts[i, :self.dsize[i]] += self.conditional(i, state)
+                    counts[clamped, state[clamped]] += 1
+                elif samples is None:
+                    counts[variables, state] += 1
+                k += 1
+                if samples is None or rao_blackwell:
+                    history.update(k, lambda: counts / float(k))
+        if samples is not None and not rao_blackwell:
+            marginals = self.array_marginals(samples)
+        else:
+            marginals = history.result(k, lambda: counts / float(max(k, 1)))
+        return bprop.InferenceResult(marginals, dict(self.domains),
+                                     self.vobs, samples=samples,
+                                     trajectory=trajectory, state=state)
+
+    def run_chains(self, nchains, nsweeps, burnin=0, step=1, processes=None,
+                   seed=None, chromatic=False, record='full',
+                   rao_blackwell=False, thin=None):
+        """Run independent chains of ``run_sweeps`` in a process pool.
+
+        Each chain gets its own random stream, derived from ``seed`` with
+        ``numpy.random.SeedSequence``. Only the precomputed tables are sent
+        to the workers (see ``detach``), and every chain reduces its samples
+        to marginals in its own process, according to ``record``. The
+        marginal estimates of the chains are averaged, and the convergence
+        of each variable is diagnosed by the R-hat and the effective sample
+        size of the indicators of its values (taking the worst value). The
+        diagnostics are computed from the recorded samples if ``record`` is
+        'full', and from the thinned trajectories otherwise.
+
+        Arguments
+        ---------
+        nchains : int
+            Number of chains.
+
+        nsweeps, burnin, step, chromatic, record, rao_blackwell :
+            Passed on to ``run_sweeps`` for each chain.
+
+        thin : int
+            Passed on to ``run_sweeps`` for each chain. Unless ``record`` is
+            'full', it defaults to a value that keeps about ``TRACE_LENGTH``
+            states per chain.
+
+        processes : int
+            Number of worker processes. Defaults to None (number of CPUs). If
+            1, all chains are run in the current process.
+
+        seed : int
+            Seed for the random streams of the chains. Defaults to None (fresh
+            entropy).
+
+        Returns
+        -------
+        A ``bprop.InferenceResult`` with the averaged marginals (one row per
+        recorded sweep or checkpoint), variable domains, and observations.
+        The samples of all chains (a K x N x n array, or None, unless
+        ``record`` is 'full'), their thinned trajectories (a K x M x n array,
+        or None), as well as dictionaries with the R-hat and the effective
+        sample size of each variable are available as the ``samples``,
+        ``trajectory``, ``rhat``, and ``ess`` attributes.
+        """
+        if record != 'full' and thin is None:
+            thin = max(((nsweeps + step - 1) // step) // TRACE_LENGTH, 1)
+        seeds = [ss.generate_state(4) for ss in
+                 np.random.SeedSequence(seed).spawn(nchains)]
+        if chromatic:
+            self.color_classes()
+        kwargs = dict(nsweeps=nsweeps, burnin=burnin, step=step,
+                      chromatic=chromatic, record=record,
+                      rao_blackwell=rao_blackwell, thin=thin)
+        sampler = self.detach()
+        tasks = [(sampler, chain_seed, kwargs) for chain_seed in seeds]
+        if processes == 1:
+            results = list(map(run_chain, tasks))
+        else:
+            pool = multiprocessing.Pool(processes)
+            try:
+                results = pool.map(run_chain, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        marginals = {v: np.mean([r[0][v] for r in results], axis=0)
+                     for v in self.names}
+        samples = trajectory = None
+        if record == 'full':
+            samples = np.array([r.samples for r in results])
+        if thin is not None:
+            trajectory = np.array([r.trajectory for r in results])
+        rhat, ess = self.diagnose(samples if samples is not None
+                                  else trajectory)
+        return bprop.InferenceResult(marginals, dict(self.domains),
+                                     self.vobs, samples=samples,
+                                     trajectory=trajectory, rhat=rhat,
+                                     ess=ess)
+
+    def run_adaptive(self, variables=None, target_ess=None,
+                     target_mcse=None, batch=1000, max_sweeps=10**6,
+                     chromatic=False, init_state=None, record='final',
+                     rao_blackwell=False):
+        """Run ``run_sweeps`` until the estimates are accurate enough.
+
+        The chain is extended in batches of sweeps that grow with its
+        length. Its recorded samples are summarized online by the sums of
+        their value indicators (or of their conditionals, if
+        ``rao_blackwell`` is True) over consecutive blocks of sweeps. When
+        there are more than ``2 * BATCHES`` blocks, neighboring blocks are
+        merged and the block length is doubled, so that the summary has a
+        fixed size, however long the chain runs.
+
+        After each batch, the burn-in period is chosen as the shortest prefix
+        of blocks (out of 0%, 10%, ..., 50% of them) after which the Geweke
+        z-scores of the block means of all values of the queried variables
+        are below 2. The Monte Carlo standard error of each value is then
+        estimated from the variance of the remaining block means (batch
+        means), and its effective sample size as p (1 - p) / MCSE^2, where p
+        is the estimated probability of the value. Sampling stops as soon as
+        all targets are met, or after ``max_sweeps`` sweeps.
+
+        Arguments
+        ---------
+        variables : iterable of str
+            The queried variables. Defaults to None (all unobserved
+            variables).
+
+        target_ess : float
+            Minimum effective sample size of every value of each queried
+            variable.
+
+        target_mcse : float
+            Maximum Monte Carlo standard error of the marginal probability of
+            every value of each queried variable.
+
+        batch : int
+            Minimum number of sweeps between two checks.
+
+        max_sweeps : int
+            Maximum total number of sweeps, including burn-in.
+
+        chromatic, init_state, rao_blackwell :
+            Passed on to ``run_sweeps``.
+
+        record : str
+            Either 'final' (only return the final marginals), or 'full'
+            (return the marginals after every sample after the burn-in
+            period, and store all samples). Defaults to 'final'.
+
+        Returns
+        -------
+        A ``bprop.InferenceResult`` with the marginals computed from the
+        samples after the burn-in period, variable domains, and observations,
+        same as ``run_sweeps``. The samples after the burn-in period (None,
+        unless ``record`` is 'full'), the burn-in length, the total number of
+        sweeps, whether the targets were met, and dictionaries with the
+        achieved effective sample size and Monte Carlo standard error of each
+        queried variable are available as the ``samples``, ``burnin``,
+        ``nsweeps``, ``converged``, ``ess``, and ``mcse`` attributes.
+        """
+        if target_ess is None and target_mcse is None:
+            raise RuntimeError('Either target_ess or target_mcse is required')
+        if record not in ('final', 'full'):
+            raise RuntimeError("Invalid recording mode '{0}'".format(record))
+        if variables is None:
+            variables = [self.names[i] for i in self.free]
+        elif isinstance(variables, str):
+            variables = [variables]
+        for v in variables:
+            if v not in self.index:
+                raise RuntimeError("Unknown variable '{0}'".format(v))
+        assert max_sweeps > 0
+        n = len(self.names)
+        dmax = max(self.dsize)
+        # Block sums of the recorded samples and the length of each block.
+        sums = np.zeros((0, n, dmax))
+        sizes = np.zeros(0, dtype=int)
+        block = max(batch // BATCHES, 1)
+        # Cumulative sums and samples of all sweeps, if ``record`` is 'full'.
+        cumsums = []
+        chunks = []
+        total = 0
+        burnin = None
+        converged = False
+        while not converged and total < max_sweeps:
+            nsweeps = max(batch, total // 4)
+            nsweeps = min(-(-nsweeps // block) * block, max_sweeps - total)
+            result = self.run_sweeps(
+                nsweeps, init_state=init_state, chromatic=chromatic,
+                record='full' if record == 'full' else block,
+                rao_blackwell=rao_blackwell)
+            init_state = dict(zip(self.names, result.state))
+            # Turn the recorded running averages into cumulative sums.
+            marginals = result[0]
+            counts = (np.arange(1, nsweeps + 1) if record == 'full' else
+                      np.minimum(np.arange(1, len(marginals[self.names[0]]) +
+                                           1) * block, nsweeps))
+            cumsum = np.zeros((len(counts), n, dmax))
+            for i, v in enumerate(self.names):
+                cumsum[:, i, :self.dsize[i]] = marginals[v] * counts[:, None]
+            if record == 'full':
+                cumsums.append(cumsum + (cumsums[-1][-1] if cumsums else 0))
+                chunks.append(result.samples)
+                ends = np.append(np.arange(block, nsweeps, block), nsweeps)
+                cumsum = cumsum[ends - 1]
+            sums = np.concatenate((sums, np.diff(cumsum, axis=0,
+                                                 prepend=0)))
+            sizes = np.append(sizes, np.diff(np.append(0, np.minimum(
+                np.arange(1, len(cumsum) + 1) * block, nsweeps))))
+            total += nsweeps
+            while len(sums) > 2 * BATCHES:
+                m = len(sums) // 2 * 2
+                sums = np.concatenate((sums[:m:2] + sums[1:m:2], sums[m:]))
+                sizes = np.append(sizes[:m:2] + sizes[1:m:2], sizes[m:])
+                block *= 2
+            burnin = self.find_burnin(sums / sizes[:, None, None], variables)
+            if burnin is None:
+                continue
+            ess, mcse = self.accuracy(sums[burnin:], sizes[burnin:],
+                                      variables)
+            converged = all(
+                (target_ess is None or ess[v] >= target_ess) and
+                (target_mcse is None or mcse[v] <= target_mcse)
+                for v in variables)
+        if burnin is None:
+            burnin = len(sums) // 2
+            ess, mcse = self.accuracy(sums[burnin:], sizes[burnin:],
+                                      variables)
+        # Convert the burn-in period from blocks to sweeps.
+        nburnin = int(np.sum(sizes[:burnin]))
+        samples = None
+        if record == 'full':
+            cumsum = np.concatenate(cumsums)
+            if nburnin > 0:
+                cumsum = cumsum[nburnin:] - cumsum[nburnin - 1]
+            averages = cumsum / np.arange(1, len(cumsum) + 1)[:, None, None]
+            samples = np.concatenate(chunks)[nburnin:]
+        else:
+            averages = (np.sum(sums[burnin:], axis=0) /
+                        max(total - nburnin, 1))[np.newaxis]
+        marginals = {v: averages[:, i, :self.dsize[i]]
+                     for i, v in enumerate(self.names)}
+        return bprop.InferenceResult(marginals, dict(self.domains),
+                                     self.vobs, samples=samples,
+                                     burnin=nburnin, nsweeps=total,
+                                     converged=converged, ess=ess, mcse=mcse)
+
+    def find_burnin(self, means, variables):
+        """Find the shortest burn-in period for ``run_adaptive``.
+
+        Arguments
+        ---------
+        means : array
+            A B x n x D array of the block means of the chain.
+
+        variables : iterable of str
+            The queried variables.
+
+        Returns
+        -------
+        The burn-in length in blocks, or None if the Geweke test fails for
+        all candidate lengths.
+        """
+        n = len(means)
+        for burnin in range(0, n // 2 + 1, max(n // 10, 1)):
+            if all(abs(geweke(means[burnin:, self.index[v], d])) < 2
+                   for v in variables
+                   for d in range(self.dsize[self.index[v]])):
+                return burnin
+        return None
+
+    def accuracy(self, sums, sizes, variables):
+        """Compute the effective sample size and Monte Carlo standard error
+        of the queried ``variables`` with the method of batch means.
+
+        Arguments
+        ---------
+        sums : array
+            A B x n x D array of the block sums of the chain.
+
+        sizes : array
+            The number of samples of each block.
+
+        variables : iterable of str
+            The queried variables.
+
+        Returns
+        -------
+        A tuple of two dictionaries that map each variable to the smallest
+        effective sample size and the largest standard error, respectively,
+        of its values.
+        """
+        nsamples = np.sum(sizes)
+        means = sums / sizes[:, None, None]
+        ess = {}
+        mcse = {}
+        for v in variables:
+            i = self.index[v]
+            p = np.sum(sums[:, i, :self.dsize[i]], axis=0) / nsamples
+            if len(sums) < 2:
+                se = np.full(self.dsize[i], np.inf)
+            else:
+                se = np.sqrt(np.var(means[:, i, :self.dsize[i]], axis=0,
+                                    ddof=1) / len(sums))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                n_eff = np.where(se > 0, p * (1 - p) / se ** 2, nsamples)
+            ess[v] = np.min(n_eff)
+            mcse[v] = np.max(se)
+        return ess, mcse
+
+    def diagnose(self, samples):
+        """Compute the R-hat and effective sample size of every variable.
+
+        Arguments
+        ---------
+        samples : array
+            A K x N x n array of samples from K chains.
+
+        Returns
+        -------
+        A tuple of two dictionaries that map each variable to the largest
+        R-hat and the smallest effective sample size, respectively, of the
+        indicators of its values.
+        """
+        rhat = {}
+        ess = {}
+        for i, v in enumerate(self.names):
+            indicators = [samples[:, :, i] == d for d in range(self.dsize[i])]
+            rhat[v] = max(gelman_rubin(x) for x in indicators)
+            ess[v] = min(effective_sample_size(x) for x in indicators)
+        return rhat, ess
+
+    def init_state(self, init_state=None, rng=npr):
+        """Draw a random initial state as an integer array, optionally
+        overwritten by the value indices given in ``init_state``. Observed
+        variables are set to their observed values.
+
+        The random numbers are drawn from ``rng`` (by default, the global
+        NumPy random state)."""
+        state = (rng.rand(len(self.names)) * self.dsize).astype(int)
+        if init_state is not None:
+            for v, d in init_state.items():
+                state[self.index[v]] = d
+        for v, d in self.observed.items():
+            state[self.index[v]] = d
+        return state
+
+    def state_dtype(self):
+        """Get the smallest integer type that can hold all value indices."""
+        return state_dtype(self.dsize)
+
+    def array_marginals(self, samples):
+        """Compute approximate marginals from an N x n array of samples.
+
+        Returns
+        -------
+        Same as ``get_marginals``.
+        """
+        marginals = {}
+        for i, v in enumerate(self.names):
+            indicators = samples[:, i, np.newaxis] == np.arange(self.dsize[i])
+            marginals[v] = np.cumsum(indicators, axis=0, dtype=float)
+            marginals[v] /= np.arange(1, len(samples) + 1)[:, np.newaxis]
+        return marginals
+
     def get_marginals(self, samples):
         """Compute approximate marginals.
 
@@ -143,7 +977,7 @@ class GibbsSampler:
         A dictionary that maps each variable v to a N x |domain(v)| array,
         where the i-th row holds the estimated marginals after i samples.
         """
-        niter = len(samples.values()[0])
+        niter = len(list(samples.values())[0])
         assert niter >= 1
         marginals = {
             v: np.zeros((niter, len(self.vs[v].domain))) for v in samples}
@@ -154,3 +988,159 @@ class GibbsSampler:
                 bin_array[v_samples == d] = 1
                 marginals[v][:, i] = cumulative_average(bin_array)
         return marginals
+
+
+class ForwardSampler:
+    def __init__(self, bn):
+        """Ancestral sampler with likelihood weighting for Bayesian networks.
+
+        Arguments
+        ---------
+        bn : core.BayesNet
+            The network to sample from. All variables need CPTs.
+        """
+        self.bn = bn
+        self.update_bn()
+
+    def update_bn(self):
+        """Should be called when the associated network is updated."""
+        self.vs = self.bn.vs
+        self.precompute()
+
+    def precompute(self):
+        """Tabulate the CPTs in topological order for vectorized sampling.
+
+        Variables are stored in topological order in ``self.names``. For the
+        i-th variable, the parent indices are ``self.parents[i]`` and the row
+        of its CPT for a given parent state is
+
+            sum_k state[self.parents[i][k]] * self.strides[i][k].
+
+        ``self.cpts[i]`` holds the CPT with one row per parent state, and
+        ``self.cdfs[i]`` holds its cumulative sums, with the row index added
+        to every row, so that all samples of a variable can be drawn by a
+        single ``searchsorted`` over the flattened table.
+        """
+        self.names = [v for v in self.bn.topological_order() if v in self.vs]
+        self.index = {v: i for i, v in enumerate(self.names)}
+        self.dsize = np.array([len(self.vs[v].domain) for v in self.names],
+                              dtype=int)
+        self.parents = []
+        self.strides = []
+        self.cpts = []
+        self.cdfs = []
+        for v in self.names:
+            if self.vs[v].cpt is None:
+                raise RuntimeError("Variable '{0}' has no CPT".format(v))
+            cpt = self.vs[v].cpt
+            table = cpt.reshape((-1, cpt.shape[-1]))
+            parents = np.array([self.index[u] for u in self.vs[v].parents],
+                               dtype=int)
+            strides = np.ones(len(parents), dtype=int)
+            for k in reversed(range(len(parents) - 1)):
+                strides[k] = strides[k + 1] * self.dsize[parents[k + 1]]
+            cdf = np.cumsum(table, axis=1)
+            cdf /= cdf[:, -1:]
+            self.parents.append(parents)
+            self.strides.append(strides)
+            self.cpts.append(table)
+            self.cdfs.append((cdf + np.arange(len(cdf))[:, None]).ravel())
+
+    def sample(self, nsamples, observations=None):
+        """Draw ``nsamples`` weighted samples at once.
+
+        Unobserved variables are sampled from their CPTs given the sampled
+        values of their parents. Observed variables are fixed to their
+        observed values, and each sample is weighted by the likelihood of
+        the observations given its parents. Without observations, all
+        weights are 1 and this is plain forward sampling.
+
+        Arguments
+        ---------
+        nsamples : int
+            Number of samples.
+
+        observations : dict
+            Maps observed variables to their observed values.
+
+        Returns
+        -------
+        A tuple of an N x n integer array of value indices, with the columns
+        in the order of ``self.names``, and an array of N log-weights.
+        """
+        observed = self.check_observations(observations or {})
+        samples = np.empty((nsamples, len(self.names)),
+                           dtype=state_dtype(self.dsize))
+        logw = np.zeros(nsamples)
+        for i in range(len(self.names)):
+            if len(self.parents[i]):
+                rows = np.dot(samples[:, self.parents[i]], self.strides[i])
+            else:
+                rows = np.zeros(nsamples, dtype=int)
+            if i in observed:
+                samples[:, i] = observed[i]
+                with np.errstate(divide='ignore'):
+                    logw += np.log(self.cpts[i][rows, observed[i]])
+            else:
+                d = self.dsize[i]
+                u = rows + npr.rand(nsamples)
+                values = np.searchsorted(self.cdfs[i], u, side='right')
+                samples[:, i] = np.minimum(values - rows * d, d - 1)
+        return samples, logw
+
+    def run(self, nsamples, observations=None, step=1):
+        """Estimate marginals with likelihood weighting.
+
+        Arguments
+        ---------
+        nsamples : int
+            Number of samples.
+
+        observations : dict
+            Maps observed variables to their observed values.
+
+        step : int
+            Only every ``step``-th row of the cumulative estimates is
+            returned.
+
+        Returns
+        -------
+        A tuple of computed marginals, variable domains, and observations,
+        same as that returned by ``GibbsSampler.run``. The i-th row of each
+        marginal holds the weighted average of the first ``i * step + 1``
+        samples, and is NaN while all of these samples have zero weight.
+        The samples and log-weights are available as the ``samples`` and
+        ``logw`` attributes of the result.
+        """
+        if observations is None:
+            observations = {}
+        samples, logw = self.sample(nsamples, observations)
+        weights = np.exp(logw - np.max(logw))
+        total = np.cumsum(weights)[::step]
+        marginals = {}
+        for i, v in enumerate(self.names):
+            marginals[v] = np.empty((len(total), self.dsize[i]))
+            for d in range(self.dsize[i]):
+                weighted = np.where(samples[:, i] == d, weights, 0)
+                marginals[v][:, d] = np.cumsum(weighted)[::step]
+            with np.errstate(invalid='ignore'):
+                marginals[v] /= total[:, np.newaxis]
+        domains = {v: self.vs[v].domain for v in self.names}
+        return bprop.InferenceResult(marginals, domains, dict(observations),
+                                     samples=samples, logw=logw)
+
+    def check_observations(self, observations):
+        """Raise an error if ``observations`` contains unknown variables or
+        values, and return them as a dictionary from variable indices to
+        value indices."""
+        observed = {}
+        for name, value in observations.items():
+            if name not in self.index:
+                raise RuntimeError("Unknown variable '{0}'".format(name))
+            domain = list(self.vs[name].domain)
+            if value not in domain:
+                raise RuntimeError(
+                    "Invalid value '{0}' for variable '{1}'".format(
+                        value, name))
+            observed[self.index[name]] = domain.index(value)
+        return observed
@@ -0,0 +1,303 @@
+import json
+import os
+import numpy as np
+import bprop
+import core
+import exact
+
+
+# Format version written to the metadata of every saved model.
+VERSION = 1
+
+
+def save_bayesnet(bn, path):
+    """Save a Bayesian network to the directory ``path``.
+
+    The network is stored as three files:
+
+        * ``meta.json``: the variable names and domains,
+        * ``structure.npz``: the parents of all variables as integer index
+          arrays in compressed sparse row form (the parents of the i-th
+          variable are ``parent_idx[parent_ptr[i]:parent_ptr[i + 1]]``), and
+          the start of the CPT of each variable in the table buffer (-1, if
+          it has none),
+        * ``tables.npy``: all CPTs, flattened and concatenated into a single
+          contiguous buffer.
+
+    Domain values have to be representable in JSON.
+
+    Arguments
+    ---------
+    bn : core.BayesNet
+        The network.
+
+    path : str
+        The directory. It is created, if it does not exist.
+    """
+    names = list(bn.vs.keys())
+    index = {v: i for i, v in enumerate(names)}
+    parents = [bn.vs[v].parents or () for v in names]
+    parent_ptr = np.cumsum([0] + [len(ps) for ps in parents])
+    parent_idx = np.array([index[p] for ps in parents for p in ps],
+                          dtype=np.int64)
+    cpt_start = np.full(len(names), -1, dtype=np.int64)
+    tables = []
+    offset = 0
+    for i, v in enumerate(names):
+        cpt = bn.vs[v].cpt
+        if cpt is not None:
+            cpt_start[i] = offset
+            tables.append(np.ravel(cpt))
+            offset += np.size(cpt)
+    meta = {'kind': 'bayesnet',
+            'version': VERSION,
+            'names': names,
+            'domains': [list(bn.vs[v].domain) for v in names]}
+    write(path, meta, dict(parent_ptr=parent_ptr, parent_idx=parent_idx,
+                           cpt_start=cpt_start), tables)
+
+
+def load_bayesnet(path, mmap=True, validate=False):
+    """Load a Bayesian network saved by ``save_bayesnet``.
+
+    Arguments
+    ---------
+    path : str
+        The directory.
+
+    mmap : bool
+        Whether to memory-map the table buffer read-only instead of reading
+        it. The CPTs of the network are then views into the mapped file, so
+        that all processes that load the same model share one physical copy
+        of the tables. Defaults to True.
+
+    validate : bool
+        Whether to check the structure and the CPTs after loading. See
+        ``core.BayesNet.validate``. Defaults to False.
+
+    Returns
+    -------
+    The network.
+    """
+    meta, structure, tables = read(path, 'bayesnet', mmap)
+    names = meta['names']
+    domains = dict(zip(names, (from_json(d) for d in meta['domains'])))
+    parent_ptr = structure['parent_ptr']
+    parent_idx = structure['parent_idx']
+    parents = {}
+    cpts = {}
+    for i, v in enumerate(names):
+        start = structure['cpt_start'][i]
+        if start < 0:
+            continue
+        parents[v] = [names[j] for j in
+                      parent_idx[parent_ptr[i]:parent_ptr[i + 1]]]
+        shape = tuple(len(domains[u]) for u in parents[v] + [v])
+        cpts[v] = tables[start:start + int(np.prod(shape))].reshape(shape)
+    return core.BayesNet.from_spec(domains, parents, cpts, validate=validate)
+
+
+def save_compiled(cgraph, path):
+    """Save a compiled factor graph to the directory ``path``.
+
+    The layout is the same as for ``save_bayesnet``. ``structure.npz`` holds
+    the variable of every edge, the unary log-potentials of the observed
+    variables, and the table shape, the number of factors and the edges of
+    each group of factors (see ``bprop.CompiledFactorGraph``).
+    ``tables.npy`` holds the flat buffer of all factor tables. The
+    observations of the graph are stored in ``meta.json``.
+
+    Arguments
+    ---------
+    cgraph : bprop.CompiledFactorGraph
+        The compiled graph.
+
+    path : str
+        The directory. It is created, if it does not exist.
+    """
+    shapes = [table.shape[1:] for table, _ in cgraph.groups]
+    meta = {'kind': 'compiled',
+            'version': VERSION,
+            'names': cgraph.names,
+            'domains': [list(cgraph.domains[v]) for v in cgraph.names],
+            'vobs': cgraph.vobs}
+    structure = dict(
+        edge_var=cgraph.edge_var,
+        evidence=cgraph.evidence,
+        shape_ptr=np.cumsum([0] + [len(shape) for shape in shapes]),
+        shape_values=np.array([s for shape in shapes for s in shape],
+                              dtype=np.int64),
+        group_count=np.array([len(table) for table, _ in cgraph.groups],
+                             dtype=np.int64),
+        group_edges=np.concatenate(
+            [gedges.ravel() for _, gedges in cgraph.groups] or
+            [np.zeros(0, dtype=np.int64)]))
+    write(path, meta, structure, [cgraph.tables])
+
+
+def load_compiled(path, mmap=True):
+    """Load a compiled factor graph saved by ``save_compiled``.
+
+    Arguments
+    ---------
+    path : str
+        The directory.
+
+    mmap : bool
+        Whether to memory-map the table buffer read-only. See
+        ``load_bayesnet``. Defaults to True.
+
+    Returns
+    -------
+    A ``bprop.CompiledFactorGraph``.
+    """
+    meta, structure, tables = read(path, 'compiled', mmap)
+    # The graph is restored from its arrays, without a FactorGraph.
+    cgraph = bprop.CompiledFactorGraph.__new__(bprop.CompiledFactorGraph)
+    cgraph.setup(meta['names'], [from_json(d) for d in meta['domains']],
+                 {name: from_json(value)
+                  for name, value in meta['vobs'].items()},
+                 structure['edge_var'])
+    cgraph.tables = tables
+    cgraph.groups = []
+    shape_ptr = structure['shape_ptr']
+    offset = 0
+    eoffset = 0
+    for g, count in enumerate(structure['group_count']):
+        shape = tuple(structure['shape_values'][shape_ptr[g]:
+                                                shape_ptr[g + 1]])
+        size = count * int(np.prod(shape))
+        table = tables[offset:offset + size].reshape((count,) + shape)
+        gedges = structure['group_edges'][eoffset:eoffset + count * len(shape)]
+        cgraph.groups.append((table, gedges.reshape((count, len(shape)))))
+        offset += size
+        eoffset += count * len(shape)
+    cgraph.evidence = structure['evidence']
+    return cgraph
+
+
+def save_junction_tree(jtree, path):
+    """Save a compiled junction tree to the directory ``path``.
+
+    The layout is the same as for ``save_bayesnet``. ``structure.npz`` holds
+    the variables of each clique, the pairs of neighboring cliques and the
+    variables of their separators, all as integer index arrays in
+    compressed sparse row form. ``tables.npy`` holds the log-potentials of
+    all cliques. The observations of the tree are stored in ``meta.json``;
+    cached messages are not saved.
+
+    Arguments
+    ---------
+    jtree : exact.JunctionTree
+        The junction tree.
+
+    path : str
+        The directory. It is created, if it does not exist.
+    """
+    names = list(jtree.domains)
+    index = {v: i for i, v in enumerate(names)}
+    edges = jtree.edges()
+    separators = [[v for v in jtree.cliques[i] if v in jtree.cliques[j]]
+                  for i, j in edges]
+    meta = {'kind': 'junction_tree',
+            'version': VERSION,
+            'names': names,
+            'domains': [list(jtree.domains[v]) for v in names],
+            'vobs': jtree.vobs}
+    structure = dict(
+        clique_ptr=np.cumsum([0] + [len(c) for c in jtree.cliques]),
+        clique_idx=np.array([index[v] for c in jtree.cliques for v in c],
+                            dtype=np.int64),
+        edges=np.array(edges, dtype=np.int64).reshape((-1, 2)),
+        separator_ptr=np.cumsum([0] + [len(sep) for sep in separators]),
+        separator_idx=np.array([index[v] for sep in separators for v in sep],
+                               dtype=np.int64))
+    write(path, meta, structure,
+          [np.ravel(potential) for potential in jtree.potentials])
+
+
+def load_junction_tree(path, mmap=True):
+    """Load a junction tree saved by ``save_junction_tree``.
+
+    Arguments
+    ---------
+    path : str
+        The directory.
+
+    mmap : bool
+        Whether to memory-map the table buffer read-only. See
+        ``load_bayesnet``. Defaults to True.
+
+    Returns
+    -------
+    An ``exact.JunctionTree``, conditioned on the saved observations.
+    """
+    meta, structure, tables = read(path, 'junction_tree', mmap)
+    names = meta['names']
+    domains = dict(zip(names, (from_json(d) for d in meta['domains'])))
+    ptr = structure['clique_ptr']
+    cliques = [tuple(names[i] for i in structure['clique_idx'][a:b])
+               for a, b in zip(ptr[:-1], ptr[1:])]
+    edges = [tuple(int(k) for k in edge) for edge in structure['edges']]
+    ptr = structure['separator_ptr']
+    for (i, j), a, b in zip(edges, ptr[:-1], ptr[1:]):
+        separator = [names[k] for k in structure['separator_idx'][a:b]]
+        if separator != [v for v in cliques[i] if v in cliques[j]]:
+            raise RuntimeError("Invalid separator of cliques {0} and "
+                               "{1}".format(i, j))
+    potentials = []
+    offset = 0
+    for c in cliques:
+        shape = tuple(len(domains[v]) for v in c)
+        size = int(np.prod(shape))
+        potentials.append(tables[offset:offset + size].reshape(shape))
+        offset += size
+    # The tree is restored from its arrays, without a BayesNet.
+    jtree = exact.JunctionTree.__new__(exact.JunctionTree)
+    jtree.setup(domains, cliques, edges, potentials)
+    jtree.condition({name: from_json(value)
+                     for name, value in meta['vobs'].items()})
+    return jtree
+
+
+def from_json(value):
+    """Convert the lists in a value read from JSON back to tuples, so that
+    tuple-valued domain values are hashable again."""
+    if isinstance(value, list):
+        return tuple(from_json(v) for v in value)
+    return value
+
+
+def write(path, meta, structure, tables):
+    """Write the files of a saved model to the directory ``path``."""
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    try:
+        text = json.dumps(meta)
+    except TypeError:
+        raise RuntimeError('Domain values need to be representable in JSON')
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        f.write(text)
+    np.savez(os.path.join(path, 'structure.npz'), **structure)
+    np.save(os.path.join(path, 'tables.npy'),
+            np.concatenate(tables or [np.zeros(0)]).astype(float))
+
+
+def read(path, kind, mmap=True):
+    """Read the files of a saved model of the given kind from the directory
+    ``path``.
+
+    Returns
+    -------
+    A tuple of the metadata, the structure arrays, and the table buffer.
+    """
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    if meta.get('kind') != kind or meta.get('version') != VERSION:
+        raise RuntimeError("Not a saved model of kind '{0}': '{1}'".format(
+            kind, path))
+    with np.load(os.path.join(path, 'structure.npz')) as npz:
+        structure = dict(npz.items())
+    tables = np.load(os.path.join(path, 'tables.npy'),
+                     mmap_mode='r' if mmap else None)
+    return meta, structure, tables
@@ -0,0 +1,105 @@
+import io
+import unittest2
+import numpy as np
+from ..examples_bprop import bn_earthquake
+from ..bif import read_bif, read_xmlbif
+
+
+BIF = u'''
+// The earthquake network.
+network earthquake {
+  property "source http://example.org/earthquake";
+}
+variable Earthquake {
+  type discrete [ 2 ] { 0, 1 };
+}
+variable Burglar { type discrete [ 2 ] { 0, 1 }; }
+variable Radio {
+  type discrete [ 2 ] { 0, 1 };
+}
+variable Alarm {
+  type discrete [ 2 ] { 0, 1 };
+  property "position = (1, 2)";
+}
+variable Phone {
+  type discrete [ 2 ] { 0, 1 };
+}
+probability ( Earthquake ) {
+  table 0.999, 0.001;
+}
+probability ( Burglar ) { table 0.999, 0.001; }
+/* Rows of a table may be given
+   in any order. */
+probability ( Radio | Earthquake ) {
+  (1) 0.5, 0.5;
+  (0) 1.0, 0.0;
+}
+probability ( Alarm | Burglar, Earthquake ) {
+  table 0.999, 0.98901, 0.00999, 0.0098901,
+        0.001, 0.01099, 0.99001, 0.9901099;
+}
+probability ( Phone | Alarm ) {
+  default 0.3, 0.7;
+  (0) 1, 0;
+}
+'''
+
+XMLBIF = u'''<?xml version="1.0"?>
+<BIF VERSION="0.3">
+<NETWORK>
+<NAME>earthquake</NAME>
+<VARIABLE TYPE="nature"><NAME>Earthquake</NAME>
+  <OUTCOME>0</OUTCOME><OUTCOME>1</OUTCOME></VARIABLE>
+<VARIABLE TYPE="nature"><NAME>Burglar</NAME>
+  <OUTCOME>0</OUTCOME><OUTCOME>1</OUTCOME></VARIABLE>
+<VARIABLE TYPE="nature"><NAME>Radio</NAME>
+  <OUTCOME>0</OUTCOME><OUTCOME>1</OUTCOME></VARIABLE>
+<VARIABLE TYPE="nature"><NAME>Alarm</NAME>
+  <OUTCOME>0</OUTCOME><OUTCOME>1</OUTCOME>
+  <PROPERTY>position = (1, 2)</PROPERTY></VARIABLE>
+<VARIABLE TYPE="nature"><NAME>Phone</NAME>
+  <OUTCOME>0</OUTCOME><OUTCOME>1</OUTCOME></VARIABLE>
+<DEFINITION><FOR>Earthquake</FOR><TABLE>0.999 0.001</TABLE></DEFINITION>
+<DEFINITION><FOR>Burglar</FOR><TABLE>0.999 0.001</TABLE></DEFINITION>
+<DEFINITION><FOR>Radio</FOR><GIVEN>Earthquake</GIVEN>
+  <TABLE>1 0 0.5 0.5</TABLE></DEFINITION>
+<DEFINITION><FOR>Alarm</FOR><GIVEN>Burglar</GIVEN><GIVEN>Earthquake</GIVEN>
+  <TABLE>0.999 0.001 0.98901 0.01099 0.00999 0.99001 0.0098901 0.9901099
+  </TABLE></DEFINITION>
+<DEFINITION><FOR>Phone</FOR><GIVEN>Alarm</GIVEN>
+  <TABLE>1 0 0.3 0.7</TABLE></DEFINITION>
+</NETWORK>
+</BIF>
+'''
+
+
+class TestBIF(unittest2.TestCase):
+    def check(self, bn):
+        expected = bn_earthquake()
+        self.assertEqual(set(bn.edges()), set(expected.edges()))
+        for v in expected.vs.values():
+            self.assertEqual(bn.vs[v.name].domain, ('0', '1'))
+            self.assertEqual(bn.vs[v.name].parents, v.parents)
+            self.assertTrue(np.allclose(bn.vs[v.name].cpt, v.cpt))
+
+    def test_bif(self):
+        timings = {}
+        self.check(read_bif(io.StringIO(BIF), timings=timings))
+        self.assertEqual(set(timings), {'parse', 'build'})
+
+    def test_default_after_rows(self):
+        text = BIF.replace('''
+  default 0.3, 0.7;
+  (0) 1, 0;''', '''
+  (0) 1, 0;
+  default 0.3, 0.7;''')
+        self.check(read_bif(io.StringIO(text)))
+
+    def test_xmlbif(self):
+        self.check(read_xmlbif(io.BytesIO(XMLBIF.encode('utf-8'))))
+
+    def test_invalid(self):
+        self.assertRaises(RuntimeError, read_bif,
+                          io.StringIO(BIF.replace('( Burglar )', '( Thief )')))
+        self.assertRaises(RuntimeError, read_bif,
+                          io.StringIO(BIF.replace('0.5, 0.5', '0.5, 0.6')))
@@ -1,5 +1,6 @@
 import unittest2
-from ..examples_bprop import bn_earthquake
+import numpy as np
+from ..examples_bprop import bn_earthquake, bn_naive_bayes
 from ..bprop import FactorGraph
 
 
@@ -17,3 +18,126 @@ class TestBeliefPropagation(unittest2.TestCase):
         fg.condition({'Phone': 1, 'Radio': 1})
         marg, _, _ = fg.run_bp(10)
         self.assertAlmostEqual(marg['Burglar'][-1, 0], 0.917, places=3)
+
+    def test_naive_bayes(self):
+        g = bn_naive_bayes()
+        fg = FactorGraph(g)
+        fg.condition({'X1': 'H', 'X2': 'T'})
+        marg, _, _ = fg.run_bp(5)
+        self.assertAlmostEqual(marg['Coin'][-1, 0], 2.0 / 7, places=6)
+        self.assertAlmostEqual(marg['Coin'][-1, 1], 3.0 / 7, places=6)
+
+    def test_compiled_earthquake(self):
+        g = bn_earthquake()
+        fg = FactorGraph(g)
+        fg.condition({'Phone': 1, 'Radio': 1})
+        marg, _, _ = fg.run_bp(10)
+        cmarg, _, _ = fg.compile().run_bp(10)
+        # Evidence factors become unary potentials of the compiled graph, so
+        # only the converged marginals agree.
+        for v in marg:
+            self.assertTrue(np.allclose(marg[v][-1], cmarg[v][-1]))
+
+    def test_compiled_condition(self):
+        g = bn_earthquake()
+        cfg = FactorGraph(g).compile()
+        cfg.condition({'Phone': 1})
+        marg, _, _ = cfg.run_bp(10)
+        self.assertAlmostEqual(marg['Burglar'][-1, 0], 0.505, places=3)
+
+    def test_compiled_retract(self):
+        fg = FactorGraph(bn_earthquake())
+        fg.condition({'Phone': 1})
+        cfg = fg.compile()
+        cfg.retract(['Phone'])
+        marg, _, _ = cfg.run_bp(10)
+        self.assertAlmostEqual(marg['Burglar'][-1, 0], 0.999)
+        cfg.condition({'Phone': 0})
+        marg, _, obs = cfg.run_bp(10)
+        self.assertEqual(obs, {'Phone': 0})
+        self.assertEqual(marg['Phone'][-1, 0], 1)
+        marg, _, _ = cfg.run_bp_batch([{'Phone': 1}], 10)
+        self.assertAlmostEqual(marg['Burglar'][0, 0], 0.505, places=3)
+        self.assertRaises(RuntimeError, cfg.condition, {'Phone': 2})
+        self.assertRaises(RuntimeError, cfg.run_bp_batch, [{'Phone': 2}], 10)
+
+    def test_residual_earthquake(self):
+        g = bn_earthquake()
+        fg = FactorGraph(g)
+        fg.condition({'Phone': 1, 'Radio': 1})
+        result = fg.run_residual_bp(tol=1e-8)
+        marg, _, _ = result
+        self.assertAlmostEqual(marg['Burglar'][-1, 0], 0.917, places=3)
+        self.assertLess(result.residual, 1e-8)
+
+    def test_tolerance_damping(self):
+        g = bn_earthquake()
+        fg = FactorGraph(g)
+        fg.condition({'Phone': 1, 'Radio': 1})
+        for damping in [0, 0.5]:
+            result = fg.run_bp(100, tol=1e-8, damping=damping)
+            marg, _, _ = result
+            self.assertLess(result.niter, 100)
+            self.assertLess(result.residual, 1e-8)
+            self.assertEqual(marg['Burglar'].shape, (result.niter + 1, 2))
+            self.assertAlmostEqual(marg['Burglar'][-1, 0], 0.917, places=3)
+
+    def test_record(self):
+        g = bn_earthquake()
+        fg = FactorGraph(g)
+        fg.condition({'Phone': 1})
+        full, _, _ = fg.run_bp(10)
+        for record, rows in [('none', []), ('final', [10]),
+                             (4, [0, 4, 8, 10])]:
+            marg, _, _ = fg.run_bp(10, record=record)
+            self.assertTrue(np.allclose(marg['Burglar'],
+                                        full['Burglar'][rows]))
+
+    def test_batch(self):
+        g = bn_earthquake()
+        fg = FactorGraph(g)
+        marg, _, obs = fg.run_bp_batch([{'Phone': 1},
+                                        {'Phone': 1, 'Radio': 1}], 10)
+        self.assertEqual(marg['Burglar'].shape, (2, 2))
+        self.assertAlmostEqual(marg['Burglar'][0, 0], 0.505, places=3)
+        self.assertAlmostEqual(marg['Burglar'][1, 0], 0.917, places=3)
+        self.assertEqual(obs[1], {'Phone': 1, 'Radio': 1})
+
+    def test_exact_trees(self):
+        g = bn_earthquake()
+        fg = FactorGraph(g)
+        fg.condition({'Phone': 1, 'Radio': 1})
+        result = fg.run_bp(10, exact_trees=True)
+        marg, _, _ = result
+        self.assertEqual(result.niter, 1)
+        self.assertAlmostEqual(marg['Burglar'][-1, 0], 0.91727797, places=6)
+        result = fg.run_bp(10)
+        self.assertEqual(result.niter, 10)
+        self.assertEqual(result[0]['Burglar'].shape, (11, 2))
+
+    def test_retract(self):
+        g = bn_earthquake()
+        fg = FactorGraph(g)
+        fg.condition({'Phone': 1, 'Radio': 1})
+        nfactors = len(fg.fs)
+        fg.retract(['Radio'])
+        marg, _, obs = fg.run_bp(10)
+        self.assertAlmostEqual(marg['Burglar'][-1, 0], 0.505, places=3)
+        self.assertEqual(obs, {'Phone': 1})
+        fg.condition({'Radio': 1})
+        marg, _, _ = fg.run_bp(10)
+        self.assertAlmostEqual(marg['Burglar'][-1, 0], 0.917, places=3)
+        self.assertEqual(len(fg.fs), nfactors)
+
+    def test_warm_start(self):
+        g = bn_earthquake()
+        fg = FactorGraph(g)
+        fg.condition({'Phone': 1})
+        cold = fg.run_residual_bp(tol=1e-10)
+        fg.condition({'Radio': 1})
+        warm = fg.run_residual_bp(tol=1e-10, warm_start=True)
+        marg, _, _ = warm
+        self.assertAlmostEqual(marg['Burglar'][-1, 0], 0.917, places=3)
+        self.assertLess(warm.nupdates, cold.nupdates)
+        marg, _, _ = fg.run_bp(10, warm_start=True)
+        self.assertAlmostEqual(marg['Burglar'][-1, 0], 0.917, places=3)
@@ -1,4 +1,5 @@
 import unittest2
+import numpy as np
 from .. import core
 from ..examples_dsep import *
 
@@ -36,12 +37,91 @@ class TestMisc(unittest2.TestCase):
                  (1,): 0.4}
         self.assertFalse(core.is_valid_cpt(table))
 
+    def test_check_cpt_array(self):
+        self.assertTrue(core.is_valid_cpt(np.array([[0.2, 0.8], [1, 0]])))
+        self.assertFalse(core.is_valid_cpt(np.array([[0.2, 0.7], [1, 0]])))
+        self.assertFalse(core.is_valid_cpt(np.array([[1.5, -0.5], [1, 0]])))
+
 
 class TestBayesNet(unittest2.TestCase):
     def test_double_variable(self):
         g = core.BayesNet()
         self.assertRaises(RuntimeError, g.add_variable('X', (0, 1)))
 
+    def test_array_cpt(self):
+        g = core.BayesNet()
+        g.add_variable('X', ('a', 'b'))
+        g.add_variable('Y', (0, 1, 2))
+        g.add_cpt(None, 'X', {'a': 0.25, 'b': 0.75})
+        table = np.array([[0.5, 0.5, 0], [0.1, 0.2, 0.7]])
+        g.add_cpt('X', 'Y', table)
+        self.assertTrue(np.array_equal(g.vs['X'].cpt, [0.25, 0.75]))
+        self.assertTrue(np.array_equal(g.vs['Y'].cpt, table))
+        self.assertTrue(g.has_edge('X', 'Y'))
+        self.assertRaises(RuntimeError, g.add_cpt, 'X', 'Y', table.T)
+        self.assertRaises(RuntimeError, g.add_cpt, 'X', 'Y', table * 2)
+        self.assertRaises(RuntimeError, g.add_cpt, None, 'X', {'c': 1})
+        # Parent configurations without entries get a uniform distribution.
+        g.add_cpt('X', 'Y', {('a', 0): 0.5, ('a', 1): 0.5})
+        self.assertTrue(np.allclose(g.vs['Y'].cpt,
+                                    [[0.5, 0.5, 0], [1. / 3, 1. / 3, 1. / 3]]))
+
+    def test_from_spec(self):
+        domains = {'X': (0, 1), 'Y': (0, 1), 'Z': ('a', 'b', 'c')}
+        parents = {'Y': ['X'], 'Z': ('X', 'Y')}
+        z = np.full((2, 2, 3), 1.0 / 3)
+        cpts = {'X': {0: 0.4, 1: 0.6},
+                'Y': np.array([[0.9, 0.1], [0.2, 0.8]]),
+                'Z': z}
+        g = core.BayesNet.from_spec(domains, parents, cpts)
+        self.assertEqual(set(g.edges()), {('X', 'Y'), ('X', 'Z'), ('Y', 'Z')})
+        self.assertEqual(g.vs['Z'].parents, ('X', 'Y'))
+        self.assertTrue(np.array_equal(g.vs['X'].cpt, [0.4, 0.6]))
+        cpts['Z'] = z[:, :, :2]
+        self.assertRaises(RuntimeError, core.BayesNet.from_spec, domains,
+                          parents, cpts)
+        cpts['Z'] = z * 0.9
+        self.assertRaises(RuntimeError, core.BayesNet.from_spec, domains,
+                          parents, cpts)
+        cpts['Z'] = z
+        parents['X'] = ['Z']
+        cpts['X'] = np.full((3, 2), 0.5)
+        self.assertRaises(RuntimeError, core.BayesNet.from_spec, domains,
+                          parents, cpts)
+        g = core.BayesNet.from_spec(domains, parents, cpts, validate=False)
+        self.assertTrue(g.has_edge('Z', 'X'))
+        self.assertRaises(RuntimeError, core.BayesNet.from_spec,
+                          {'A': (0, 1), 'B': (0, 1)}, {'B': ['A']},
+                          {'A': [0.5, 0.5]})
+        g = core.BayesNet.from_spec({1: (0, 1), 2: (0, 1)}, {2: [1]},
+                                    {1: [0.5, 0.5], 2: np.eye(2)})
+        self.assertEqual(set(g.edges()), {('1', '2')})
+        self.assertEqual(g.vs['2'].parents, ('1',))
+
+    def test_graph_store(self):
+        g = core.BayesNet()
+        g.add_nodes_from(['X', 'Y', 'Z'])
+        g.add_edges_from([('X', 'Z'), ('Y', 'Z'), ('X', 'Z')])
+        g.add_edge('W', 'X')
+        self.assertEqual(g.nodes(), ['X', 'Y', 'Z', 'W'])
+        # Local queries do not merge the pending edges.
+        self.assertEqual(g.predecessors('Z'), ['X', 'Y'])
+        self.assertEqual(g.successors('W'), ['X'])
+        self.assertTrue(g.has_edge('W', 'X'))
+        self.assertEqual(len(g.pending), 3)
+        self.assertEqual(g.edges(), [('X', 'Z'), ('Y', 'Z'), ('W', 'X')])
+        self.assertEqual(g.pending, [])
+        g.add_edge('W', 'Z')
+        self.assertEqual(g.predecessors('Z'), ['X', 'Y', 'W'])
+        self.assertFalse(g.has_edge('Z', 'X'))
+        order = g.topological_order()
+        for u, v in g.edges():
+            self.assertLess(order.index(u), order.index(v))
+        self.assertEqual(set(g.to_networkx().edges()), set(g.edges()))
+        g.add_edge('Z', 'W')
+        self.assertRaises(RuntimeError, g.topological_order)
+        self.assertRaises(RuntimeError, g.predecessors, 'V')
+
 
 class TestDSeparation(unittest2.TestCase):
     def check_anc(self, g, z, correct):
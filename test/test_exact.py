@@ -0,0 +1,65 @@
+import unittest2
+import numpy as np
+from ..bprop import logsumexp
+from ..examples_bprop import bn_earthquake, bn_naive_bayes
+from ..exact import VariableElimination, JunctionTree, HEURISTICS
+
+
+class TestVariableElimination(unittest2.TestCase):
+    def test_earthquake(self):
+        ve = VariableElimination(bn_earthquake())
+        for heuristic in HEURISTICS:
+            marg, _, _ = ve.query(['Burglar', 'Phone'],
+                                  {'Phone': 1, 'Radio': 1}, heuristic)
+            self.assertAlmostEqual(marg['Burglar'][-1, 0], 0.917, places=3)
+            self.assertEqual(marg['Phone'][-1, 1], 1)
+
+    def test_naive_bayes(self):
+        ve = VariableElimination(bn_naive_bayes())
+        marg, _, _ = ve.query('Coin', {'X1': 'H', 'X2': 'T'})
+        self.assertAlmostEqual(marg['Coin'][-1, 1], 3.0 / 7)
+
+    def test_plan(self):
+        ve = VariableElimination(bn_earthquake())
+        plan = ve.plan('Burglar', {'Phone': 1})
+        self.assertEqual(set(plan.order), set(['Alarm', 'Earthquake']))
+        self.assertEqual(plan.width, 2)
+        self.assertEqual(plan.max_table_size, 8)
+        self.assertRaises(RuntimeError, ve.query, 'Burglar', {'Phone': 1},
+                          max_table_size=4)
+
+
+class TestJunctionTree(unittest2.TestCase):
+    def test_earthquake(self):
+        jt = JunctionTree(bn_earthquake())
+        jt.condition({'Phone': 1})
+        marg, _, _ = jt.query(['Burglar'])
+        self.assertAlmostEqual(marg['Burglar'][-1, 0], 0.505, places=3)
+        jt.condition({'Radio': 1})
+        marg, _, _ = jt.query(['Burglar'])
+        self.assertAlmostEqual(marg['Burglar'][-1, 0], 0.917, places=3)
+        jt.retract(['Radio'])
+        marg, _, obs = jt.query(['Burglar'])
+        self.assertAlmostEqual(marg['Burglar'][-1, 0], 0.505, places=3)
+        self.assertEqual(obs, {'Phone': 1})
+
+    def test_incremental(self):
+        ve = VariableElimination(bn_naive_bayes())
+        jt = JunctionTree(bn_naive_bayes())
+        total = jt.calibrate()
+        jt.condition({'X1': 'H'})
+        self.assertLess(jt.calibrate(), total)
+        marg, _, _ = jt.query()
+        vmarg, _, _ = ve.query(list(marg), {'X1': 'H'})
+        for v in marg:
+            self.assertAlmostEqual(marg[v][-1, 0], vmarg[v][-1, 0])
+        # Beliefs can be computed before the tree is calibrated.
+        fresh = JunctionTree(bn_naive_bayes())
+        vmarg, _, _ = ve.query(list(marg))
+        for k, c in enumerate(fresh.cliques):
+            belief = fresh.belief(k)
+            for a, v in enumerate(c):
+                table = logsumexp(belief, axis=tuple(
+                    b for b in range(len(c)) if b != a))
+                self.assertTrue(np.allclose(np.exp(table - logsumexp(table)),
+                                            vmarg[v][-1]))
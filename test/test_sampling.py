@@ -0,0 +1,252 @@
+import unittest2
+import numpy as np
+from ..examples_bprop import bn_earthquake
+from ..bprop import FactorGraph
+from ..exact import VariableElimination
+from ..sampling import (GibbsSampler, ForwardSampler, gelman_rubin,
+                        effective_sample_size, geweke)
+
+
+class TestGibbsSampler(unittest2.TestCase):
+    def test_precompute(self):
+        sampler = GibbsSampler(FactorGraph(bn_earthquake()))
+        state = {'Earthquake': 0, 'Alarm': 1, 'Radio': 0, 'Phone': 0}
+        i = sampler.index['Burglar']
+        row = sampler.offset[i] + sum(
+            state[sampler.names[u]] * stride
+            for u, stride in zip(sampler.mb[i], sampler.strides[i]))
+        p = np.array([0.999 * 0.001, 0.001 * 0.99001])
+        self.assertTrue(np.allclose(sampler.cond[row], p / p.sum()))
+
+    def test_sample_var(self):
+        fg = FactorGraph(bn_earthquake())
+        fg.condition({'Phone': 1})
+        state = {'Earthquake': 0, 'Burglar': 1, 'Radio': 0, 'Alarm': 0,
+                 'Phone': 1}
+        for max_table_size in [0, 10**6]:
+            sampler = GibbsSampler(fg, max_table_size)
+            self.assertEqual(sampler.sample_var('Alarm', state), 1)
+            self.assertEqual(sampler.sample_var('Radio', state), 0)
+
+    def test_run_sweeps(self):
+        np.random.seed(0)
+        fg = FactorGraph(bn_earthquake())
+        fg.condition({'Phone': 1})
+        sampler = GibbsSampler(fg)
+        result = sampler.run_sweeps(5000, burnin=100, step=2)
+        marg, _, _ = result
+        self.assertEqual(result.samples.shape, (2500, 5))
+        self.assertEqual(result.samples.dtype, np.int8)
+        self.assertAlmostEqual(marg['Burglar'][-1, 0], 0.505, delta=0.05)
+
+    def test_untabulated(self):
+        bn = bn_earthquake()
+        fg = FactorGraph(bn)
+        fg.condition({'Phone': 1})
+        exact, _, _ = VariableElimination(bn).query(['Burglar'], {'Phone': 1})
+        for kwargs in [dict(max_table_size=4), dict(max_total_size=8)]:
+            sampler = GibbsSampler(fg, **kwargs)
+            self.assertTrue(np.any(sampler.offset[sampler.free] < 0))
+            self.assertLessEqual(sampler.cond.size, 8)
+            for options in [{}, dict(chromatic=True),
+                            dict(rao_blackwell=True)]:
+                np.random.seed(0)
+                marg, _, _ = sampler.run_sweeps(3000, burnin=100, **options)
+                self.assertTrue(np.allclose(marg['Burglar'][-1],
+                                            exact['Burglar'][-1], atol=0.05))
+
+    def test_chromatic(self):
+        np.random.seed(0)
+        fg = FactorGraph(bn_earthquake())
+        fg.condition({'Phone': 1})
+        sampler = GibbsSampler(fg)
+        colors = sampler.color_classes()
+        for c in colors:
+            for i in c:
+                blanket = sampler.mb[i][sampler.strides[i] > 0]
+                self.assertFalse(set(blanket) & set(c))
+        marg, _, _ = sampler.run_sweeps(5000, burnin=100, chromatic=True)
+        self.assertAlmostEqual(marg['Burglar'][-1, 0], 0.505, delta=0.05)
+
+    def test_run_chains(self):
+        fg = FactorGraph(bn_earthquake())
+        fg.condition({'Phone': 1})
+        sampler = GibbsSampler(fg)
+        result = sampler.run_chains(2, 2000, burnin=100, processes=2, seed=0)
+        marg, _, _ = result
+        self.assertEqual(result.samples.shape, (2, 2000, 5))
+        self.assertAlmostEqual(marg['Burglar'][-1, 0], 0.505, delta=0.05)
+        self.assertLess(result.rhat['Burglar'], 1.1)
+        self.assertGreater(result.ess['Burglar'], 100)
+        again = sampler.run_chains(2, 2000, burnin=100, processes=1, seed=0)
+        self.assertTrue(np.array_equal(result.samples, again.samples))
+        self.assertFalse(hasattr(sampler.detach(), 'fgraph'))
+        result = sampler.run_chains(2, 2000, burnin=100, processes=2, seed=0,
+                                    record='final')
+        marg, _, _ = result
+        self.assertIsNone(result.samples)
+        self.assertEqual(result.trajectory.shape, (2, 1000, 5))
+        self.assertEqual(marg['Burglar'].shape, (1, 2))
+        self.assertAlmostEqual(marg['Burglar'][-1, 0], 0.505, delta=0.05)
+        self.assertLess(result.rhat['Burglar'], 1.1)
+        # The chains do not touch the global random state.
+        np.random.seed(1)
+        expected = np.random.rand()
+        np.random.seed(1)
+        sampler.run_chains(2, 100, processes=1, seed=7)
+        self.assertEqual(np.random.rand(), expected)
+
+    def test_diagnostics(self):
+        rng = np.random.RandomState(0)
+        iid = rng.rand(4, 1000)
+        self.assertAlmostEqual(gelman_rubin(iid), 1, places=2)
+        self.assertGreater(effective_sample_size(iid), 3000)
+        walk = np.cumsum(rng.randn(4, 1000), axis=1)
+        self.assertGreater(gelman_rubin(walk), 1.1)
+        self.assertLess(effective_sample_size(walk), 100)
+
+    def test_streaming(self):
+        fg = FactorGraph(bn_earthquake())
+        fg.condition({'Phone': 1})
+        sampler = GibbsSampler(fg)
+        np.random.seed(0)
+        first = sampler.run_sweeps(1000, burnin=10)
+        full, _, _ = first
+        np.random.seed(0)
+        result = sampler.run_sweeps(1000, burnin=10, record=300)
+        marg, _, _ = result
+        self.assertIsNone(result.samples)
+        for v in marg:
+            self.assertTrue(np.allclose(marg[v],
+                                        full[v][[299, 599, 899, 999]]))
+        np.random.seed(0)
+        result = sampler.run_sweeps(1000, burnin=10, record='final', thin=300)
+        self.assertEqual(result.trajectory.shape, (4, 5))
+        self.assertTrue(np.array_equal(result.trajectory,
+                                       first.samples[[0, 300, 600, 900]]))
+        np.random.seed(0)
+        full, _, _ = sampler.run(1000, burnin=10)
+        np.random.seed(0)
+        marg, _, _ = sampler.run(1000, burnin=10, record=300)
+        self.assertEqual(full['Burglar'].shape, (1000, 2))
+        for v in marg:
+            self.assertTrue(np.allclose(marg[v],
+                                        full[v][[299, 599, 899, 999]]))
+
+    def test_clamped(self):
+        fg = FactorGraph(bn_earthquake())
+        fg.condition({'Phone': 1, 'Alarm': 0})
+        sampler = GibbsSampler(fg)
+        phone, alarm = sampler.index['Phone'], sampler.index['Alarm']
+        self.assertEqual(sorted(sampler.free),
+                         sorted(set(range(5)) - {phone, alarm}))
+        for classes in sampler.color_classes():
+            self.assertNotIn(phone, classes)
+            self.assertNotIn(alarm, classes)
+        blankets = sampler.mb[sampler.strides > 0]
+        self.assertNotIn(alarm, blankets)
+        np.random.seed(0)
+        result = sampler.run_sweeps(200, chromatic=True)
+        self.assertTrue(np.all(result.samples[:, phone] == 1))
+        self.assertTrue(np.all(result.samples[:, alarm] == 0))
+        observed = {'Earthquake': 0, 'Burglar': 1, 'Radio': 0, 'Alarm': 1,
+                    'Phone': 1}
+        fg = FactorGraph(bn_earthquake())
+        fg.condition(observed)
+        marg, _, _ = GibbsSampler(fg).run(10)
+        for v, value in observed.items():
+            self.assertEqual(marg[v][-1, value], 1)
+
+    def test_rao_blackwell(self):
+        bn = bn_earthquake()
+        fg = FactorGraph(bn)
+        fg.condition({'Phone': 1})
+        exact, _, _ = VariableElimination(bn).query(['Burglar'], {'Phone': 1})
+        sampler = GibbsSampler(fg)
+        np.random.seed(0)
+        result = sampler.run_sweeps(2000, burnin=100, rao_blackwell=True)
+        marg, _, _ = result
+        self.assertEqual(result.samples.shape, (2000, 5))
+        self.assertEqual(marg['Burglar'].shape, (2000, 2))
+        self.assertTrue(np.allclose(marg['Burglar'].sum(axis=1), 1))
+        self.assertTrue(np.all(marg['Phone'] == [0, 1]))
+        self.assertTrue(np.allclose(marg['Burglar'][-1], exact['Burglar'][-1],
+                                    atol=0.05))
+        np.random.seed(0)
+        final, _, _ = sampler.run_sweeps(2000, burnin=100, record='final',
+                                         rao_blackwell=True)
+        self.assertTrue(np.allclose(final['Burglar'], marg['Burglar'][-1]))
+        # Across independent chains, the Rao-Blackwellized estimates vary
+        # less than the averages of the indicators.
+        estimates = {}
+        for rao_blackwell in (False, True):
+            estimates[rao_blackwell] = [
+                sampler.run_sweeps(200, burnin=10, record='final',
+                                   rao_blackwell=rao_blackwell,
+                                   rng=np.random.RandomState(seed))[0][
+                                       'Burglar'][-1, 0]
+                for seed in range(20)]
+        self.assertLess(np.var(estimates[True]),
+                        np.var(estimates[False]) / 10)
+
+    def test_adaptive(self):
+        sampler = GibbsSampler(FactorGraph(bn_earthquake()))
+        np.random.seed(0)
+        result = sampler.run_adaptive(['Alarm'], target_ess=300, batch=500,
+                                      record='full')
+        self.assertTrue(result.converged)
+        self.assertGreaterEqual(result.ess['Alarm'], 300)
+        self.assertEqual(len(result.samples), result.nsweeps - result.burnin)
+        self.assertEqual(len(result[0]['Alarm']), len(result.samples))
+        self.assertTrue(np.allclose(
+            result[0]['Alarm'], sampler.array_marginals(result.samples)[
+                'Alarm']))
+        np.random.seed(0)
+        final = sampler.run_adaptive(['Alarm'], target_ess=300, batch=500)
+        self.assertIsNone(final.samples)
+        self.assertEqual(final.nsweeps, result.nsweeps)
+        self.assertTrue(np.allclose(final[0]['Alarm'], result[0]['Alarm'][-1]))
+        exact, _, _ = VariableElimination(bn_earthquake()).query(['Alarm'])
+        rb = sampler.run_adaptive(['Alarm'], target_mcse=0.005, batch=500,
+                                  rao_blackwell=True, chromatic=True)
+        self.assertTrue(rb.converged)
+        self.assertTrue(np.allclose(rb[0]['Alarm'], exact['Alarm'][-1],
+                                    atol=0.02))
+        np.random.seed(0)
+        result = sampler.run_adaptive(['Alarm'], target_ess=10**9,
+                                      batch=500, max_sweeps=1000)
+        self.assertFalse(result.converged)
+        self.assertEqual(result.nsweeps, 1000)
+        with self.assertRaises(RuntimeError):
+            sampler.run_adaptive(['Alarm'])
+
+    def test_geweke(self):
+        np.random.seed(0)
+        self.assertLess(abs(geweke(np.random.rand(1000))), 3)
+        self.assertGreater(geweke(np.arange(1000) < 100), 3)
+
+
+class TestForwardSampler(unittest2.TestCase):
+    def test_topological(self):
+        sampler = ForwardSampler(bn_earthquake())
+        np.random.seed(0)
+        samples, logw = sampler.sample(1000)
+        self.assertEqual(samples.shape, (1000, 5))
+        self.assertTrue(np.all(logw == 0))
+        for i, parents in enumerate(sampler.parents):
+            self.assertTrue(np.all(parents < i))
+
+    def test_likelihood_weighting(self):
+        bn = bn_earthquake()
+        observations = {'Phone': 1}
+        exact, _, _ = VariableElimination(bn).query(['Burglar'], observations)
+        np.random.seed(0)
+        result = ForwardSampler(bn).run(200000, observations, step=1000)
+        marg, _, obs = result
+        self.assertEqual(obs, observations)
+        self.assertEqual(marg['Burglar'].shape, (200, 2))
+        self.assertTrue(np.all(marg['Phone'][-1] == [0, 1]))
+        self.assertTrue(np.allclose(marg['Burglar'][-1], exact['Burglar'][-1],
+                                    atol=0.05))
+        with self.assertRaises(RuntimeError):
+            ForwardSampler(bn).run(10, {'Phone': 2})
@@ -0,0 +1,82 @@
+import shutil
+import tempfile
+import unittest2
+import numpy as np
+from ..examples_bprop import bn_earthquake, bn_naive_bayes
+from ..bprop import FactorGraph
+from ..core import BayesNet
+from ..exact import VariableElimination, JunctionTree
+from ..serialize import (save_bayesnet, load_bayesnet, save_compiled,
+                         load_compiled, save_junction_tree,
+                         load_junction_tree)
+
+
+class TestSerialize(unittest2.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_bayesnet(self):
+        bn = bn_naive_bayes()
+        save_bayesnet(bn, self.path)
+        loaded = load_bayesnet(self.path, validate=True)
+        self.assertEqual(set(loaded.edges()), set(bn.edges()))
+        for v in bn.vs.values():
+            self.assertEqual(loaded.vs[v.name].domain, v.domain)
+            self.assertEqual(loaded.vs[v.name].parents, v.parents)
+            self.assertTrue(np.array_equal(loaded.vs[v.name].cpt, v.cpt))
+        marg, _, _ = VariableElimination(loaded).query('Coin',
+                                                       {'X1': 'H', 'X2': 'T'})
+        self.assertAlmostEqual(marg['Coin'][-1, 1], 3.0 / 7)
+
+    def test_compiled(self):
+        fg = FactorGraph(bn_earthquake())
+        fg.condition({'Phone': 1})
+        cgraph = fg.compile()
+        cgraph.condition({'Radio': 1})
+        save_compiled(cgraph, self.path)
+        loaded = load_compiled(self.path)
+        self.assertIsInstance(loaded.tables, np.memmap)
+        self.assertEqual(loaded.vobs, {'Phone': 1, 'Radio': 1})
+        expected, _, _ = cgraph.run_bp(20)
+        marg, _, _ = loaded.run_bp(20)
+        for v in expected:
+            self.assertTrue(np.allclose(marg[v], expected[v]))
+        self.assertRaises(RuntimeError, load_bayesnet, self.path)
+
+    def test_junction_tree(self):
+        bn = bn_earthquake()
+        jtree = JunctionTree(bn)
+        jtree.condition({'Phone': 1})
+        save_junction_tree(jtree, self.path)
+        loaded = load_junction_tree(self.path)
+        self.assertEqual(loaded.cliques, jtree.cliques)
+        self.assertEqual(loaded.edges(), jtree.edges())
+        self.assertIsInstance(loaded.potentials[0], np.memmap)
+        ve = VariableElimination(bn)
+        for observations in [{'Phone': 1}, {'Phone': 1, 'Radio': 1}]:
+            loaded.condition(observations)
+            marg, _, obs = loaded.query()
+            self.assertEqual(obs, observations)
+            expected, _, _ = ve.query(list(marg), observations)
+            for v in marg:
+                self.assertTrue(np.allclose(marg[v], expected[v]))
+        self.assertRaises(RuntimeError, load_compiled, self.path)
+
+    def test_tuple_domains(self):
+        bn = BayesNet.from_spec(
+            {'A': ((0, 0), (0, 1)), 'B': ('x', 'y')}, {'B': ['A']},
+            {'A': [0.3, 0.7], 'B': [[0.9, 0.1], [0.2, 0.8]]})
+        save_bayesnet(bn, self.path)
+        self.assertEqual(load_bayesnet(self.path).vs['A'].domain,
+                         ((0, 0), (0, 1)))
+        cgraph = FactorGraph(bn).compile()
+        cgraph.condition({'A': (0, 1)})
+        save_compiled(cgraph, self.path)
+        loaded = load_compiled(self.path)
+        self.assertEqual(loaded.vobs, {'A': (0, 1)})
+        loaded.condition({'A': (0, 0)})
+        marg, _, _ = loaded.run_bp(10)
+        self.assertTrue(np.allclose(marg['B'][-1], [0.9, 0.1]))